@@ -0,0 +1,442 @@
+"""Load test of mongofuse: mounts it on a temporary directory and runs mixed
+workloads of file system users from many threads."""
+
+# Standard modules:
+import os
+import sys
+import time
+import json
+import errno
+import math
+import random
+import shutil
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import collections
+import datetime
+import distutils.spawn
+
+# Third-party modules:
+import pymongo
+
+log = logging.getLogger("mongofuse.loadtest")
+
+DB = "mongofuse_loadtest"
+COLLECTION = "docs"
+
+# Seconds to wait for mongod and the mount to come up
+STARTUP_TIMEOUT = 30
+
+
+class LoadTest(object):
+    """Workloads run on mongofuse mounted at `mount_point`.
+
+    ``db``
+        MongoDB connection string of the server mongofuse mount uses.
+
+    ``documents``
+        Number of documents seeded into the collection under test.
+
+    ``mix``
+        Mapping of workload names (see `WORKLOADS`) to their weights.
+
+    """
+
+    # Workload name => method, in order of reports
+    WORKLOADS = collections.OrderedDict([
+        ("ls", "ls_storm"),
+        ("grep", "grep_scan"),
+        ("edit", "editor_save"),
+        ("cp", "bulk_copy")])
+
+    def __init__(self, mount_point, db, documents=200, mix=None):
+        self.mount_point = mount_point
+        self.db = db
+        self.documents = documents
+        self.mix = mix or dict.fromkeys(self.WORKLOADS, 1)
+        self.folder = os.path.join(mount_point, DB, COLLECTION)
+        self._latencies = collections.defaultdict(list)  # op => [seconds]
+        self._errors = collections.Counter()              # op => number
+        self._lock = threading.Lock()
+
+    def seed(self):
+        """Fills collection under test with documents looking like typical
+        small configs and records.
+        """
+
+        conn = pymongo.Connection(self.db, safe=True)
+        conn.drop_database(DB)
+        coll = conn[DB][COLLECTION]
+        for n in range(self.documents):
+            coll.insert({"n": n,
+                         "name": "document-{}".format(n),
+                         "tags": ["tag{}".format(n % 7), "load"],
+                         "created": datetime.datetime.utcnow(),
+                         "settings": {"enabled": n % 2 == 0,
+                                      "threshold": n * 0.5,
+                                      "description": "x" * (n % 64)},
+                         "revision": 0})
+        with open(os.path.join(self.folder, "limit"), "w") as limit:
+            limit.write(str(self.documents))
+
+    def cleanup(self):
+        pymongo.Connection(self.db, safe=True).drop_database(DB)
+
+    def run(self, threads=8, duration=10):
+        """Runs workloads from `threads` threads for `duration` seconds.
+        Returns report, see `report()`.
+        """
+
+        before = self.mount_stats()
+        deadline = time.time() + duration
+        started = time.time()
+        workers = [threading.Thread(target=self._work, args=(deadline, n))
+                   for n in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - started
+        after = self.mount_stats()
+
+        return self.report(elapsed, threads, before, after)
+
+    def report(self, elapsed, threads, before, after):
+        """Returns throughput and latency percentiles of every operation,
+        with backend round trips and writes made meanwhile.
+        """
+
+        ops = collections.OrderedDict()
+        for op in sorted(self._latencies):
+            latencies = sorted(self._latencies[op])
+            ops[op] = collections.OrderedDict(
+                [("count", len(latencies)),
+                 ("errors", self._errors[op]),
+                 ("per_second", round(len(latencies) / elapsed, 2)),
+                 ("p50_ms", round(percentile(latencies, 50) * 1000, 3)),
+                 ("p99_ms", round(percentile(latencies, 99) * 1000, 3))])
+
+        return collections.OrderedDict(
+            [("finished", datetime.datetime.utcnow().isoformat()),
+             ("seconds", round(elapsed, 3)),
+             ("threads", threads),
+             ("documents", self.documents),
+             ("mix", self.mix),
+             ("ops", ops),
+             ("round_trips", after.get("round_trips", 0) -
+                             before.get("round_trips", 0)),
+             ("writes", after.get("writes", 0) - before.get("writes", 0)),
+             ("stats", after)])
+
+    def mount_stats(self):
+        """Returns counters of the mounted file system."""
+
+        with open(os.path.join(self.mount_point, "stats.json")) as stats:
+            return json.load(stats)
+
+    def ls_storm(self, rand):
+        """``ls -l``: lists the folder and stats every file."""
+
+        with self.timed("readdir"):
+            names = os.listdir(self.folder)
+        for name in names:
+            with self.timed("getattr"):
+                os.lstat(os.path.join(self.folder, name))
+
+    def grep_scan(self, rand):
+        """``grep -r``: reads every document in listing order."""
+
+        with self.timed("readdir"):
+            names = os.listdir(self.folder)
+        for name in self._documents(names):
+            with self.timed("read"):
+                with open(os.path.join(self.folder, name)) as doc:
+                    doc.read()
+
+    def editor_save(self, rand):
+        """Editor save cycle: reads document, then truncates and rewrites
+        its file with one field changed.
+        """
+
+        with self.timed("readdir"):
+            names = self._documents(os.listdir(self.folder))
+        if not names:
+            return
+        path = os.path.join(self.folder, rand.choice(names))
+        with self.timed("read"):
+            with open(path) as doc:
+                content = json.loads(doc.read())
+        content["revision"] = content.get("revision", 0) + 1
+        with self.timed("save"):
+            with open(path, "w") as doc:
+                doc.write(json.dumps(content, indent=4, sort_keys=True))
+
+    def bulk_copy(self, rand):
+        """``cp -r``: copies all documents out of the mount."""
+
+        with self.timed("readdir"):
+            names = self._documents(os.listdir(self.folder))
+        target = tempfile.mkdtemp(prefix="mongofuse-cp-")
+        try:
+            for name in names:
+                with self.timed("copy"):
+                    shutil.copy(os.path.join(self.folder, name), target)
+        finally:
+            shutil.rmtree(target)
+
+    def timed(self, op):
+        return _Timer(self, op)
+
+    def record(self, op, seconds, error=None):
+        with self._lock:
+            if error is None:
+                self._latencies[op].append(seconds)
+            else:
+                self._errors[op] += 1
+
+    def _work(self, deadline, n):
+        rand = random.Random(n)
+        names = sorted(self.mix)
+        weights = [self.mix[name] for name in names]
+        while time.time() < deadline:
+            name = weighted_choice(rand, names, weights)
+            try:
+                getattr(self, self.WORKLOADS[name])(rand)
+            except (IOError, OSError, ValueError) as e:
+                log.debug("%s failed: %s", name, e)
+
+    def _documents(self, names):
+        return [name for name in names if name.endswith(".json") and
+                name not in ("query.json", "sort.json", "pipeline.json",
+                             "explain.json", "new.json")]
+
+
+class _Timer(object):
+    """Context manager recording latency of operation `op`."""
+
+    def __init__(self, test, op):
+        self.test = test
+        self.op = op
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, type, value, traceback):
+        self.test.record(self.op, time.time() - self.started, value)
+
+
+class StandInServer(object):
+    """Throwaway mongod listening on a free local port, with data in a
+    temporary directory.
+    """
+
+    def __init__(self, mongod="mongod"):
+        self.mongod = mongod
+        self.process = None
+        self.dbpath = None
+        self.port = None
+        self.output = None
+
+    def start(self):
+        self.dbpath = tempfile.mkdtemp(prefix="mongofuse-db-")
+        self.port = free_port()
+        self.output = open(os.devnull, "w")
+        self.process = subprocess.Popen(
+            [self.mongod, "--dbpath", self.dbpath, "--port", str(self.port),
+             "--bind_ip", "127.0.0.1"],
+            stdout=self.output, stderr=subprocess.STDOUT)
+        wait_for(lambda: pymongo.Connection(self.address),
+                 "mongod at {}".format(self.address))
+        return self.address
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        if self.output is not None:
+            self.output.close()
+        if self.dbpath is not None:
+            shutil.rmtree(self.dbpath, ignore_errors=True)
+
+    @property
+    def address(self):
+        return "127.0.0.1:{}".format(self.port)
+
+
+class Mount(object):
+    """mongofuse process mounted on a temporary directory."""
+
+    def __init__(self, db, options=()):
+        self.db = db
+        self.options = list(options)
+        self.mount_point = None
+        self.process = None
+
+    def start(self):
+        self.mount_point = tempfile.mkdtemp(prefix="mongofuse-mnt-")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "mongofuse.mongofuse", self.mount_point,
+             "--foreground", "--db", self.db] + self.options)
+
+        def mounted():
+            if self.process.poll() is not None:
+                raise RuntimeError("mongofuse exited with code {}".format(
+                                   self.process.returncode))
+            if not os.path.ismount(self.mount_point):
+                raise OSError(errno.ENOENT, "Not mounted yet")
+
+        wait_for(mounted, "mount at {}".format(self.mount_point))
+        return self.mount_point
+
+    def stop(self):
+        if self.process is not None:
+            # mongofuse doesn't exit by itself if unmounting failed
+            if subprocess.call(["fusermount", "-u", self.mount_point]) and \
+                    self.process.poll() is None:
+                self.process.terminate()
+            self.process.wait()
+        if self.mount_point is not None:
+            os.rmdir(self.mount_point)
+
+
+def percentile(values, percent):
+    """Returns `percent` percentile of sorted `values`, by nearest rank.
+    """
+
+    if not values:
+        return 0
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def weighted_choice(rand, names, weights):
+    point = rand.uniform(0, sum(weights))
+    for name, weight in zip(names, weights):
+        point -= weight
+        if point <= 0:
+            return name
+    return names[-1]
+
+
+def parse_mix(string):
+    """Returns workload weights from ``"name=weight,..."`` string."""
+
+    mix = {}
+    for item in string.split(","):
+        name, _, weight = item.partition("=")
+        if name not in LoadTest.WORKLOADS:
+            raise argparse.ArgumentTypeError(
+                "Unknown workload {!r}, expected one of {}".format(
+                    name, ", ".join(LoadTest.WORKLOADS)))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(func, what, timeout=STARTUP_TIMEOUT):
+    """Calls `func` until it doesn't fail, for at most `timeout` seconds.
+    """
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return func()
+        except (OSError, pymongo.errors.ConnectionFailure):
+            if time.time() > deadline:
+                raise RuntimeError("Timed out waiting for {}".format(what))
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db",
+                        help="MongoDB to test against, HOST:PORT. Default "
+                             "is a throwaway mongod started for the test",
+                        metavar="HOST:PORT")
+    parser.add_argument("--mongod",
+                        help="mongod executable for the throwaway server. "
+                             "Default is %(default)s",
+                        default="mongod",
+                        metavar="PATH")
+    parser.add_argument("--threads",
+                        help="Number of concurrent users. "
+                             "Default is %(default)s",
+                        type=int,
+                        default=8)
+    parser.add_argument("--duration",
+                        help="Seconds to run workloads. "
+                             "Default is %(default)s",
+                        type=float,
+                        default=30,
+                        metavar="SECS")
+    parser.add_argument("--documents",
+                        help="Number of documents in collection under test. "
+                             "Default is %(default)s",
+                        type=int,
+                        default=200)
+    parser.add_argument("--mix",
+                        help="Weights of workloads, e.g. "
+                             "\"ls=4,grep=1,edit=2,cp=1\". Workloads: "
+                             "{}".format(", ".join(LoadTest.WORKLOADS)),
+                        type=parse_mix,
+                        default=None)
+    parser.add_argument("--output",
+                        help="File to save JSON report to. "
+                             "Default is stdout",
+                        metavar="PATH")
+    parser.add_argument("mount_options",
+                        help="Options of mongofuse mount, after \"--\"",
+                        nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    options = [option for option in args.mount_options if option != "--"]
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = None
+    if args.db is None:
+        if distutils.spawn.find_executable(args.mongod) is None:
+            parser.error("{} not found, give --db or --mongod".format(
+                         args.mongod))
+        server = StandInServer(args.mongod)
+
+    mount = None
+    test = None
+    try:
+        db = server.start() if server is not None else args.db
+        mount = Mount(db, options)
+        test = LoadTest(mount.start(), db, documents=args.documents,
+                        mix=args.mix)
+        test.seed()
+        log.info("Running %s threads for %s seconds", args.threads,
+                 args.duration)
+        report = test.run(threads=args.threads, duration=args.duration)
+    finally:
+        try:
+            if test is not None:
+                test.cleanup()
+        finally:
+            if mount is not None:
+                mount.stop()
+            if server is not None:
+                server.stop()
+
+    content = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(content)
+    else:
+        print content
+
+if __name__ == '__main__':
+    main()
@@ -8,22 +8,141 @@ import argparse
 import json
 import collections
 import time
+import datetime
+import logging
+import importlib
+import threading
+import hashlib
+import re
+import itertools
+import mmap
+import fcntl
+import struct
+import zlib
+import urllib
+
+
+class LazyModule(object):
+    """Module proxy which imports module `name` on first attribute access.
+
+    Keeps heavy third-party modules out of the startup path, so that
+    ``mongofuse --help`` or mounting doesn't wait for them to load.
+
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
 
 # Third-party modules:
-import pymongo
-import bson
-import bson.json_util
-from fuse import FUSE, Operations, FuseOSError, LoggingMixIn
+pymongo = LazyModule("pymongo")
+bson = LazyModule("bson")
+json_util = LazyModule("bson.json_util")
+fuse = LazyModule("fuse")
+
+log = logging.getLogger("mongofuse")
+
+# Number of documents listed in folders without limit file
+DEFAULT_LIMIT = 32
+
+TOP_BY_RE = re.compile(r"^top_(\d+)_by_(.+)$")
 
+# Mask of access mode in open() flags, missing from os module of Python 2
+O_ACCMODE = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
 
-class MongoFuse(LoggingMixIn, Operations):
+# Document file representations: pretty-printed JSON and raw BSON
+DOCUMENT_EXTENSIONS = (".json", ".bson")
+
+# Collection recording materialized pipelines, and prefix of their
+# scratch collections
+PIPELINES_COLLECTION = "mongofuse.pipelines"
+
+# Codecs of document contents in `BodyCache`: module with `compress()` and
+# `decompress()` functions, `None` to store contents as they are
+CODECS = collections.OrderedDict([
+    ("zlib", "zlib"),
+    ("lz4", "lz4.block"),
+    ("none", None)])
+
+# Read preference names accepted by --read-preference
+READ_PREFERENCES = collections.OrderedDict([
+    ("primary", "PRIMARY"),
+    ("primaryPreferred", "PRIMARY_PREFERRED"),
+    ("secondary", "SECONDARY"),
+    ("secondaryPreferred", "SECONDARY_PREFERRED"),
+    ("nearest", "NEAREST")])
+
+
+class MongoFuse(object):
     """File system interface for MongoDB.
 
     ``conn_string``
         MongoDB connection string, "host:port"
 
+    ``connect_timeout``
+        Seconds to wait for the server. Connection is established on
+        the first file system operation, not on creation.
+
+    ``replica_set``
+        Replica set name. When given, documents and listings are read
+        according to ``read_preference`` and ``max_staleness`` (see
+        `Backend`), while writes always go to the primary.
+
+    ``pipeline_ttl``
+        Seconds to reuse results of pipeline.json aggregations.
+
+    ``materialize_pipelines``
+        Store complete pipeline results in scratch collections with
+        ``$out``, so that they are reused across mounts and restarts.
+
+    ``bson_files``
+        Show every document as raw BSON ``.bson`` file too.
+
+    ``namespace_ttl``
+        Seconds to reuse database and collection names and stats.
+
+    ``collscan_limit``
+        Number of documents above which listings scanning the whole
+        collection are reported, `None` to never check.
+
+    ``collscan_action``
+        ``"warn"`` to only log such listings, ``"refuse"`` to show no
+        documents instead.
+
+    ``readahead``
+        Most documents to fetch ahead of time while a folder is read in
+        listing order, ``0`` to disable read-ahead.
+
+    ``pinned_docs``
+        Number of frequently read documents kept in the body cache apart
+        from the others (see `BodyCache`).
+
+    ``cache_bytes``, ``codec``, ``compress_min``
+        Memory budget of the body cache, codec compressing its entries
+        and size of contents to compress.
+
+    ``shared_cache``, ``shared_cache_bytes``, ``shared_ttl``
+        File of `SharedCache` used by all mounts on the host, its size, and
+        seconds its entries are reused. `None` to cache document contents
+        only in this process. Only mounts of the same ``conn_string`` and
+        ``replica_set`` see each other's entries.
+
+    Counters of backend and cache usage are shown in ``/stats.json``.
+
     """
 
+    # Seconds to reuse content of explain.json
+    EXPLAIN_TTL = 2
+
+    # Seconds to reuse document file contents
+    BODY_TTL = 2
+
     class Stat(dict):
 
         def __init__(self, **kwargs):
@@ -36,56 +155,134 @@ class MongoFuse(LoggingMixIn, Operations):
             default.update(kwargs)
             dict.__init__(self, default)
 
-    def __init__(self, conn_string):
-        self.conn = pymongo.Connection(conn_string, safe=True)
+    def __init__(self, conn_string, connect_timeout=5, replica_set=None,
+                 read_preference=None, max_staleness=None,
+                 pipeline_ttl=60, materialize_pipelines=False,
+                 bson_files=False, namespace_ttl=10, collscan_limit=None,
+                 collscan_action="warn", readahead=32, pinned_docs=256,
+                 cache_bytes=64 << 20, codec="zlib", compress_min=1024,
+                 shared_cache=None, shared_cache_bytes=64 << 20,
+                 shared_ttl=BODY_TTL):
+        self.conn_string = conn_string
+        self.connect_timeout = connect_timeout
+        self.replica_set = replica_set
+        self.pipeline_ttl = pipeline_ttl
+        self.materialize_pipelines = materialize_pipelines
+        self.extensions = DOCUMENT_EXTENSIONS if bson_files else (".json",)
+        self.collscan_limit = collscan_limit
+        self.collscan_action = collscan_action
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self.backend = Backend(lambda: self.conn,
+                               read_preference=read_preference,
+                               max_staleness=max_staleness)
         self._queries = {}                            # path => query_content
+        self._sorts = {}                              # path => sort_content
+        self._limits = {}                             # path => limit_content
+        self._pipelines = {}                          # path => pipeline_content
+        self._controls = {Node.QUERY: self._queries,  # kind => {path: content}
+                          Node.SORT: self._sorts,
+                          Node.LIMIT: self._limits,
+                          Node.PIPELINE: self._pipelines}
+        self._pipeline_results = LRUCache(expire_secs=pipeline_ttl)
+        self._checked_sorts = BoundedCache(max_size=1024)
+        self._templates = BoundedCache(max_size=1024)
+        self._collscans = BoundedCache(max_size=1024)
+        self._listings = BoundedCache(max_size=1024)  # path => timing
+        self._explains = LRUCache(expire_secs=self.EXPLAIN_TTL)
         self._created = set()
         self._dirs = collections.defaultdict(set)     # path => {subdirs}
-        self.fd = 0
+        self._fds = itertools.count(1)                # next() is atomic
         self.attrs_cache = LRUCache(expire_secs=2)
+        self.namespace_cache = LRUCache(expire_secs=namespace_ttl)
+        self._opened = BoundedCache(max_size=4096)    # path => content digest
+        self._snapshots = {}                          # fh => (doc, size)
+        self._writes = {}                             # fh => written content
+        self._unsaved = set()                         # fh written since save
+        self.bodies = BodyCache(ttl=self.BODY_TTL,
+                                max_bytes=cache_bytes,
+                                max_pinned=pinned_docs,
+                                codec=codec,
+                                compress_min=compress_min)
+        self._handles = {}                            # fh => document content
+        self.shared = None
+        if shared_cache:
+            self.shared = SharedCache(shared_cache,
+                                      size=shared_cache_bytes,
+                                      ttl=shared_ttl,
+                                      compress_min=compress_min,
+                                      namespace=(conn_string, replica_set))
+        self._readahead = ReadAhead(max_window=readahead)
+
+    def __call__(self, op, path, *args):
+        log.debug('-> %s %s %s', op, path, repr(args))
+        ret = '[Unhandled Exception]'
+        try:
+            if not hasattr(self, op):
+                raise fuse.FuseOSError(errno.EFAULT)
+            ret = getattr(self, op)(path, *args)
+            return ret
+        except OSError as e:
+            ret = str(e)
+            raise
+        except pymongo.errors.ConnectionFailure as e:
+            ret = str(e)
+            raise fuse.FuseOSError(errno.EIO)
+        finally:
+            log.debug('<- %s %s', op, repr(ret))
+
+    @property
+    def conn(self):
+        """MongoDB connection, established on first use."""
+
+        if self._conn is None:
+            with self._conn_lock:
+                if self._conn is None:
+                    timeout_ms = int(self.connect_timeout * 1000)
+                    if self.replica_set:
+                        self._conn = pymongo.MongoReplicaSetClient(
+                            self.conn_string,
+                            replicaSet=self.replica_set,
+                            connectTimeoutMS=timeout_ms)
+                    else:
+                        self._conn = pymongo.Connection(
+                            self.conn_string,
+                            safe=True,
+                            connectTimeoutMS=timeout_ms)
+        return self._conn
 
     def readdir(self, path, fh=None):
 
-        components = split_path(path)
-        dirs, fname = os.path.split(path)
+        node = resolve_path(path)
 
         # Root entries are database names
-        if len(components) == 1 and path == "/":
-            names = [".", ".."] + self.conn.database_names() 
-            st_mode = 0770 | stat.S_IFDIR
-            for name in names:
-                fullname = os.path.join(path, name)
-                self.attrs_cache[fullname] = MongoFuse.Stat(st_mode=st_mode)
-            return names
+        if node.kind == Node.ROOT:
+            return [".", ".."] + self._database_names() + ["stats.json"]
 
         # Second level entries are collection names
-        elif len(components) == 2:
-            db = components[1]
-            names = [".", ".."] + self.conn[db].collection_names()
-            st_mode = 0770 | stat.S_IFDIR
-            for name in names:
-                fullname = os.path.join(path, name)
-                self.attrs_cache[fullname] = MongoFuse.Stat(st_mode=st_mode)
-            return names
+        elif node.kind == Node.DATABASE:
+            # Scratch collections of materialized pipelines are hidden
+            return [".", ".."] + \
+                   [name for name in self._collection_names(node.db)
+                    if not name.startswith(PIPELINES_COLLECTION)]
 
         # Third and more level entries are mongo documents and user subfolders
-        elif len(components) >= 3:
+        else:
             files = [".", ".."] + \
                     self._list_documents(path) + \
-                    list(self._dirs.get(path, []))
-            if path in self._queries:
-                files += ['query.json']
+                    list(self._dirs.get(node.path, []))
+            for name, kind in sorted(Node.CONTROL_FILES.items()):
+                if node.path in self._controls.get(kind, {}):
+                    files.append(name)
+            if node.path not in self._pipelines:
+                files.append("explain.json")
             return files
 
-        else:
-            raise FuseOSError(errno.ENOENT)
-
     def getattr(self, path, fh=None):
 
         st = MongoFuse.Stat()
 
-        components = split_path(path)
-        dirs, fname = os.path.split(path)
+        node = resolve_path(path)
 
         # Try to find cached attrs
         cached = self.attrs_cache.get(path)
@@ -93,50 +290,66 @@ class MongoFuse(LoggingMixIn, Operations):
             return cached
 
         # Root entry is a directory
-        if len(components) == 1 and path == "/":
+        if node.kind == Node.ROOT:
             st['st_mode'] |= stat.S_IFDIR
 
+        # Read-only report on backend and cache usage
+        elif node.kind == Node.STATS:
+            st['st_mode'] = 0440 | stat.S_IFREG
+            st['st_size'] = len(self._stats_report())
+
         # First level entry maybe a database name
-        elif len(components) == 2 and components[-1] in self.conn.database_names():
+        elif node.kind == Node.DATABASE and \
+                node.name in self._database_names():
             st['st_mode'] |= stat.S_IFDIR
+            st.update(self._namespace_stat(node))
 
         # Second level entry maybe a collection name
-        elif len(components) == 3 and \
-                (components[-1] in self.conn[components[1]].collection_names()):
+        elif node.kind == Node.COLLECTION and \
+                node.name in self._collection_names(node.db):
             st['st_mode'] |= stat.S_IFDIR
+            st.update(self._namespace_stat(node))
 
         # User-created folders
-        elif fname in self._dirs.get(dirs, []):
+        elif node.name in self._dirs.get(node.parent, []):
             st['st_mode'] |= stat.S_IFDIR
 
-        # Special file to filter collection
-        elif fname == "query.json":
-            if dirs not in self._queries:
-                raise FuseOSError(errno.ENOENT)
+        # Special files to filter, sort and limit collection
+        elif node.kind in self._controls:
+            contents = self._controls[node.kind]
+            if node.parent not in contents:
+                raise fuse.FuseOSError(errno.ENOENT)
             st['st_mode'] |= stat.S_IFREG
-            st['st_size'] = len(self._queries[dirs])
+            st['st_size'] = len(contents[node.parent])
+
+        # Read-only report on how the folder's query runs. Explaining runs
+        # the query, so it's done only on read(): file is opened with
+        # direct_io, and its size doesn't matter
+        elif node.kind == Node.EXPLAIN:
+            if node.parent in self._pipelines:
+                raise fuse.FuseOSError(errno.ENOENT)
+            st['st_mode'] = 0440 | stat.S_IFREG
 
         # Special file to create new documents
-        elif fname == "new.json":
+        elif node.kind == Node.NEW:
             st['st_mode'] |= stat.S_IFREG
             # FIXME: Report ENOENT after new.json is saved
 
         # Thrid and more level entries are documents
-        elif len(components) >= 4:
-            doc = self._find_doc(path)
-            if doc is None:
-                # Entries prepared by create() call
-                if path not in self._created:
-                    raise FuseOSError(errno.ENOENT)
-                else:
-                    doc = ""
-
+        elif node.kind == Node.DOCUMENT:
+            size = self._document_size(path)
             st['st_mode'] |= stat.S_IFREG
-            st['st_size'] = len(dumps(doc))
+
+            if size is not None:
+                st['st_size'] = size
+
+            # Entries prepared by create() call
+            elif node.path not in self._created:
+                raise fuse.FuseOSError(errno.ENOENT)
 
         # Throw error for unknown entries
         else:
-            raise FuseOSError(errno.ENOENT)
+            raise fuse.FuseOSError(errno.ENOENT)
 
         return st
 
@@ -145,60 +358,142 @@ class MongoFuse(LoggingMixIn, Operations):
 
     def read(self, path, size, offset=0, fh=None):
 
-        components = split_path(path)
-        dirs, fname = os.path.split(path)
+        node = resolve_path(path)
 
-        if fname == "query.json" and dirs in self._queries:
-            content = self._queries[dirs]
+        if node.kind in self._controls and \
+                node.parent in self._controls[node.kind]:
+            content = self._controls[node.kind][node.parent]
 
-        elif len(components) >= 4:
-            doc = self._find_doc(path)
-            if doc is None:
-                raise FuseOSError(errno.ENOENT)
-            content = dumps(doc)
+        elif node.kind == Node.EXPLAIN:
+            content = self._explain(node.parent)
+
+        elif node.kind == Node.STATS:
+            content = self._stats_report()
+
+        elif node.kind == Node.DOCUMENT:
+            # Files written to read what's written, until saved. Content
+            # is decompressed once per open file, on first read
+            handle = file_handle(fh)
+            if handle in self._writes:
+                return str(self._writes[handle][offset:offset+size])
+            content = self._handles.get(handle) if handle else None
+            if content is None:
+                content = self._document_body(path)
+                if content is None:
+                    raise fuse.FuseOSError(errno.ENOENT)
+                if handle:
+                    self._keep_content(handle, content)
+
+        else:
+            raise fuse.FuseOSError(errno.ENOENT)
 
         return content[offset:offset+size]
 
-    def create(self, path, mode):
+    def create(self, path, mode, fi=None):
 
-        dirs, fname = os.path.split(path)
+        node = resolve_path(path)
 
-        if fname == "query.json":
-            self._queries[dirs] = "{}"
+        if node.kind in (Node.EXPLAIN, Node.STATS):
+            raise fuse.FuseOSError(errno.EROFS)
 
-#        # Allow creating files with names looking like objectid
-        try:
-            bson.objectid.ObjectId(os.path.splitext(fname)[0])
-        except bson.errors.InvalidId:
-            pass
-        else:
-            self._created.add(path)
+        elif node.kind in self._controls:
+            self._controls[node.kind][node.parent] = \
+                    Node.CONTROL_DEFAULTS[node.kind]
+
+        # Allow creating files with names looking like objectid
+        elif node.oid is not None:
+            self._created.add(node.path)
+
+        fd = next(self._fds)
+        if node.kind in (Node.DOCUMENT, Node.NEW):
+            self._writes[fd] = bytearray()
 
-        self.fd += 1
-        return self.fd
+        if fi is None:
+            return fd
 
-    def open(self, path, flags):
-        self.fd += 1
-        return self.fd
+        fi.fh = fd
+        return 0
+
+    def open(self, path, fi):
+        """Opens file. Mounted with ``raw_fi``, so that page cache can be
+        controlled per file: control files are never cached, and documents
+        keep their cached pages only while their content is unchanged.
+        """
+
+        node = resolve_path(path)
+
+        fi.fh = next(self._fds)
+
+        if node.kind in Node.CONTROL_FILES.values() or \
+                node.kind == Node.STATS:
+            fi.direct_io = True
+
+        elif node.kind == Node.DOCUMENT and \
+                fi.flags & O_ACCMODE != os.O_RDONLY:
+            if fi.flags & os.O_TRUNC:
+                self._writes[fi.fh] = bytearray()
+
+            # Fetched anew: changes are saved against the document as this
+            # file saw it (see `_save_doc()`)
+            doc = self._find_doc(path)
+            body = None
+            if doc is not None:
+                body = render(doc, node.ext)
+                self._keep_snapshot(fi.fh, doc, len(body))
+                if self._is_cacheable(node):
+                    self._cache_body(node, body)
+            fi.keep_cache = self._is_unchanged(path, body)
+
+        # Files opened for reading show content up to BODY_TTL seconds old
+        elif node.kind == Node.DOCUMENT:
+            body = self._document_body(path)
+            fi.keep_cache = self._is_unchanged(path, body)
+
+        return 0
 
     def truncate(self, path, length, fh=None):
 
-        dirs, fname = os.path.split(path)
-        
-        if fname == 'query.json' and dirs in self._queries:
-            self._queries[dirs] = self._queries[dirs][:length]
+        node = resolve_path(path)
+
+        if node.kind in (Node.EXPLAIN, Node.STATS):
+            raise fuse.FuseOSError(errno.EROFS)
+
+        elif node.kind in self._controls and \
+                node.parent in self._controls[node.kind]:
+            contents = self._controls[node.kind]
+            contents[node.parent] = contents[node.parent][:length]
+
+        # Documents are saved when written content is flushed
+        elif node.kind in (Node.DOCUMENT, Node.NEW) and file_handle(fh):
+            content = self._written(path, file_handle(fh))
+            del content[length:]
+            self._unsaved.add(file_handle(fh))
 
     def write(self, path, data, offset=0, fh=None):
 
-        components = split_path(path)
-        dirs, fname = os.path.split(path)
+        node = resolve_path(path)
 
-        if fname == "query.json":
-            self._queries[dirs] = data
+        if node.kind in self._controls:
+            self._controls[node.kind][node.parent] = data
             return len(data)
         
-        elif len(components) > 3:
+        elif node.parent in self._pipelines or \
+                node.kind in (Node.EXPLAIN, Node.STATS):
+            raise fuse.FuseOSError(errno.EROFS)
+
+        # Content written to open files is saved on flush(), as a whole:
+        # large documents come in many writes
+        elif node.kind in (Node.DOCUMENT, Node.NEW) and file_handle(fh):
+            content = self._written(path, file_handle(fh))
+            if offset > len(content):
+                content.extend("\0" * (offset - len(content)))
+            content[offset:offset + len(data)] = data
+            self._unsaved.add(file_handle(fh))
+            return len(data)
+
+        elif node.kind in (Node.DOCUMENT, Node.NEW):
             self._save_doc(path, data)
+            self._invalidate(path)
             return len(data)
 
         else:
@@ -206,9 +501,13 @@ class MongoFuse(LoggingMixIn, Operations):
 
     def unlink(self, path):
 
-        components = split_path(path)
-        if len(components) > 3:
+        node = resolve_path(path)
+        if node.parent in self._pipelines:
+            raise fuse.FuseOSError(errno.EROFS)
+
+        elif node.kind == Node.DOCUMENT:
             self._remove_doc(path)
+            self._invalidate(path)
 
         # TODO: Drop database
         # TODO: Drop collection
@@ -216,24 +515,32 @@ class MongoFuse(LoggingMixIn, Operations):
 
     def mkdir(self, path, mode):
 
-        components = split_path(path)
-        dirs, dirname = os.path.split(path)
+        node = resolve_path(path)
 
-        if dirs == "/" and not dirname in self.conn.database_names():
-            self.conn[dirname].create_collection("system.indexes")
+        if node.kind == Node.DATABASE and \
+                node.name not in self.conn.database_names():
+            self.backend.count_write()
+            self.conn[node.db].create_collection("system.indexes")
 
-        elif len(components) == 3:
-            db = components[1]
-            coll = components[2]
-            self.conn[db].create_collection(coll)
+        elif node.kind == Node.COLLECTION:
+            self.backend.count_write()
+            self.conn[node.db].create_collection(node.coll)
 
-        elif len(components) > 3 and dirname.startswith("by_"):
-            field = dirname.split("by_")[1]
+        elif node.depth > 3 and node.name.startswith("by_"):
+            field = node.name.split("by_")[1]
             query = '{"%s": $1}' % field
-            self._queries[path] = query
+            self._queries[node.path] = query
 
+        # "top_<n>_by_<field>" folders list `n` docs with greatest `field`
+        elif node.depth > 3 and TOP_BY_RE.match(node.name):
+            limit, field = TOP_BY_RE.match(node.name).groups()
+            self._sorts[node.path] = '{"%s": -1}' % field
+            self._limits[node.path] = limit
 
-        self._dirs[dirs].add(dirname)
+        if node.depth <= 3:
+            self.namespace_cache.clear()
+
+        self._dirs[node.parent].add(node.name)
 
     def chmod(self, path, mode):
         return 0
@@ -241,102 +548,601 @@ class MongoFuse(LoggingMixIn, Operations):
     def chown(self, path, uid, gid):
         pass
 
+    def utimens(self, path, times=None):
+        return 0
+
+    def access(self, path, amode):
+        return 0
+
+    def opendir(self, path):
+        return 0
+
+    def releasedir(self, path, fh):
+        return 0
+
+    def release(self, path, fh):
+        handle = file_handle(fh)
+        try:
+            self._flush_writes(path, handle)
+        finally:
+            self._writes.pop(handle, None)
+            self._drop_content(handle)
+            self._drop_snapshot(handle)
+        return 0
+
+    def flush(self, path, fh):
+        self._flush_writes(path, file_handle(fh))
+        return 0
+
     def statfs(self, path):
         # TODO: Report real data
         return dict(f_bsize=512, f_blocks=4096*1024, f_bavail=2048*1024)
 
+    # Defaults of fusepy's Operations, which MongoFuse doesn't inherit so
+    # that fuse is imported lazily. FUSE registers only operations defined
+    # here, others fail with ENOSYS.
+
+    def init(self, path):
+        pass
+
+    def destroy(self, path):
+        pass
+
+    def fsync(self, path, datasync, fh):
+        return 0
+
+    def fsyncdir(self, path, datasync, fh):
+        return 0
+
+    def listxattr(self, path):
+        return []
+
+    def setxattr(self, path, name, value, options, position=0):
+        raise fuse.FuseOSError(errno.ENOTSUP)
+
+    def removexattr(self, path, name):
+        raise fuse.FuseOSError(errno.ENOTSUP)
+
+    def readlink(self, path):
+        raise fuse.FuseOSError(errno.ENOENT)
+
+    def link(self, target, source):
+        raise fuse.FuseOSError(errno.EROFS)
+
+    def symlink(self, target, source):
+        raise fuse.FuseOSError(errno.EROFS)
+
+    def mknod(self, path, mode, dev):
+        raise fuse.FuseOSError(errno.EROFS)
+
+    def rename(self, old, new):
+        raise fuse.FuseOSError(errno.EROFS)
+
+    def rmdir(self, path):
+        raise fuse.FuseOSError(errno.EROFS)
+
+    def _database_names(self):
+        return self._namespace(("databases",), self.backend.database_names)
+
+    def _collection_names(self, db):
+        return self._namespace(("collections", db),
+                               lambda: self.backend.collection_names(db))
+
+    def _namespace_stat(self, node):
+        """Returns ``st_nlink`` and ``st_size`` of database or collection
+        folder. Taken from server's metadata, so they never cost a scan:
+        databases count collections and report data size, collections
+        report estimated document count and data size.
+        """
+
+        if node.kind == Node.DATABASE:
+            stats = self._stats(node.db, "dbstats")
+            count, size = "collections", "dataSize"
+        else:
+            stats = self._stats(node.db, "collstats", node.coll)
+            count, size = "count", "size"
+
+        return dict(st_nlink=2 + int(stats.get(count, 0)),
+                    st_size=int(stats.get(size, 0)))
+
+    def _stats(self, db, command, arg=1):
+        """Returns result of stats `command`, or `{}` if it fails."""
+
+        def fetch():
+            try:
+                return self.backend.command(db, command, arg)
+            except pymongo.errors.OperationFailure:
+                return {}
+
+        return self._namespace((command, db, arg), fetch)
+
+    def _namespace(self, key, fetch):
+        """Returns databases, collections or their stats cached under `key`
+        for `namespace_ttl` seconds, calling `fetch()` on cache miss.
+        """
+
+        value = self.namespace_cache.get(key)
+        if value is None:
+            value = fetch()
+            self.namespace_cache[key] = value
+        return value
+
     def _list_documents(self, path):
         """Returns list of MongoDB documents represented as files.
         """
 
-        components = split_path(path)
-        db = components[1]
-        coll = components[2]
-        query = self._get_query(path)
-
-        # Don't show any docs for malformed queries
-        if query is None:
-            return []
+        node = resolve_path(path)
 
         # Database names cannot contain the character '.'
-        if "." in db:
+        if "." in node.db:
             return []
 
-        docs = []
-        for doc in self.conn[db][coll].find(query).limit(32):
-            fname = "{}.json".format(doc["_id"])
-            docs.append(fname)
+        started = time.time()
+
+        # Folders with pipeline.json show results of the aggregation
+        if node.path in self._pipelines:
+            found = (self._aggregate(path) or {}).items()
+
+        else:
+            query = self._get_query(path)
+            sort = self._get_sort(path)
+            limit = self._get_limit(path)
+
+            # Don't show any docs for malformed queries
+            if query is None or sort is None or limit is None:
+                return []
 
-            # Cache doc attributes
-            st = MongoFuse.Stat(st_mode=0660 | stat.S_IFREG,
-                                st_size=len(dumps(doc)))
-            fullname = os.path.join(path, fname)
-            self.attrs_cache[fullname] = st
+            if sort:
+                self._check_sort(node, query, sort)
+
+            if not self._allow_scan(node, query, sort, limit):
+                return []
+
+            found = [("{}".format(doc["_id"]), doc)
+                     for doc in self.backend.find(node.db, node.coll, query,
+                                                  sort=sort, limit=limit)]
+
+        self._listings[node.path] = collections.OrderedDict(
+            [("finished", datetime.datetime.utcnow()),
+             ("seconds", round(time.time() - started, 6)),
+             ("documents", len(found))])
+
+        docs = []
+        for stem, doc in found:
+            for ext in self.extensions:
+                fname = "{}{}".format(stem, ext)
+                docs.append(fname)
+
+                # Cache doc attributes and content
+                body = render(doc, ext)
+                st = MongoFuse.Stat(st_mode=0660 | stat.S_IFREG,
+                                    st_size=len(body))
+                fullname = os.path.join(path, fname)
+                self.attrs_cache[fullname] = st
+                doc_node = resolve_path(fullname)
+                if self._is_cacheable(doc_node):
+                    self._cache_body(doc_node, body)
+
+        if node.path not in self._pipelines:
+            self._readahead.listed(node.path, [stem for stem, doc in found])
 
         return docs
 
+    def _allow_scan(self, node, query, sort, limit):
+        """Returns `False` if listing would scan whole collection larger
+        than `collscan_limit` documents and `collscan_action` is
+        ``"refuse"``. Logs a warning for every such listing.
+        """
+
+        if not self.collscan_limit:
+            return True
+
+        stats = self._stats(node.db, "collstats", node.coll)
+        if stats.get("count", 0) <= self.collscan_limit:
+            return True
+
+        key = (node.db, node.coll, query_key(sorted(query)), tuple(sort))
+        scans = self._collscans.get(key)
+        if scans is None:
+            plan = self.backend.explain(node.db, node.coll, query,
+                                        sort=sort, limit=limit)
+            scans = self._collscans[key] = is_collscan(plan)
+
+        if scans:
+            log.warning("Listing %s scans whole %s.%s of %d documents%s",
+                        node.path, node.db, node.coll, stats["count"],
+                        ", refused" if self.collscan_action == "refuse"
+                        else "")
+        return not scans or self.collscan_action != "refuse"
+
+    def _explain(self, path):
+        """Returns content of explain.json in `path` folder: server's
+        execution stats for the folder's query, and timing of its most
+        recent listing. Reused for `EXPLAIN_TTL` seconds.
+        """
+
+        content = self._explains.get(path)
+        if content is not None:
+            return content
+
+        node = resolve_path(path)
+        query = self._get_query(path)
+        sort = self._get_sort(path)
+        limit = self._get_limit(path)
+        report = collections.OrderedDict(
+            [("query", query),
+             ("sort", sort),
+             ("limit", limit),
+             ("lastListing", self._listings.get(node.path))])
+
+        if query is None or sort is None or limit is None:
+            report["error"] = "malformed query.json, sort.json or limit"
+
+        # Don't let explain run queries the guard keeps from listing
+        elif not self._allow_scan(node, query, sort, limit):
+            report["refused"] = "collection scan over %d documents" % \
+                                self.collscan_limit
+            report["explain"] = self.backend.explain(
+                node.db, node.coll, query, sort=sort, limit=limit)
+
+        else:
+            report["explain"] = self.backend.explain(
+                node.db, node.coll, query, sort=sort, limit=limit,
+                verbosity="executionStats")
+
+        content = json.dumps(report, indent=4, default=json_util.default)
+        self._explains[path] = content
+        return content
+
+    def _document_size(self, path):
+        """Returns length of document file at `path`, or `None` if there's
+        no such document. Cached contents aren't decompressed for it.
+        """
+
+        node = resolve_path(path)
+        if self._is_cacheable(node) and self.bodies.is_fresh(body_key(node)):
+            size = self.bodies.size(body_key(node))
+            if size is not None:
+                return size
+
+        body = self._document_body(path)
+        return len(body) if body is not None else None
+
+    def _document_body(self, path):
+        """Returns content of document file at `path`, or `None` if there's
+        no such document. Contents are served from `bodies` cache while
+        fresh, and documents following `path` in listing order are fetched
+        ahead of time when folder is read sequentially.
+        """
+
+        node = resolve_path(path)
+        cacheable = self._is_cacheable(node)
+
+        if cacheable:
+            self._read_ahead(node)
+            key = body_key(node)
+            body = self.bodies.get(key)
+
+            # Document may have been fetched by another mount
+            if body is None and self.shared is not None:
+                body = self.shared.get(key)
+                if body is not None:
+                    self.bodies.put(key, body)
+
+            if body is not None:
+                return body
+
+        doc = self._find_doc(path)
+        if doc is None:
+            return None
+
+        body = render(doc, node.ext)
+        if cacheable:
+            self._cache_body(node, body)
+        return body
+
+    def _cache_body(self, node, body, prefetched=False):
+        """Caches `body` of document file `node` for this and other mounts.
+        """
+
+        key = body_key(node)
+        self.bodies.put(key, body, prefetched=prefetched)
+        if self.shared is not None:
+            self.shared.put(key, body)
+
+    def _is_cacheable(self, node):
+        """Returns `True` if content of document file `node` may be kept in
+        `bodies` cache. Pipeline results have their own cache.
+        """
+
+        return node.oid is not None and node.parent not in self._pipelines
+
+    def _read_ahead(self, node):
+        """Fetches documents expected to be read after `node` in background.
+        """
+
+        stem = os.path.splitext(node.name)[0]
+        names = [name for name in self._readahead.accessed(node.parent, stem)
+                 if not self._is_fresh(node.parent, name)]
+        if names:
+            thread = threading.Thread(target=self._prefetch,
+                                      args=(node, names))
+            thread.daemon = True
+            thread.start()
+
+    def _is_fresh(self, folder, stem):
+        """Returns `True` if all files of document `stem` in `folder` have
+        fresh content in `bodies` cache.
+        """
+
+        for ext in self.extensions:
+            node = resolve_path(os.path.join(folder, stem + ext))
+            if not self.bodies.is_fresh(body_key(node)):
+                return False
+        return True
+
+    def _prefetch(self, node, names):
+        """Puts contents of documents `names` of `node`'s folder into `bodies`
+        cache, with one backend round trip.
+        """
+
+        oids = [bson.objectid.ObjectId(name) for name in names
+                if bson.objectid.ObjectId.is_valid(name)]
+        try:
+            docs = self.backend.find(node.db, node.coll,
+                                     {"_id": {"$in": oids}})
+        except pymongo.errors.PyMongoError as e:
+            log.warning("Read-ahead in %s failed: %s", node.parent, e)
+            return
+
+        for doc in docs:
+            for ext in self.extensions:
+                name = "{}{}".format(doc["_id"], ext)
+                prefetched = resolve_path(os.path.join(node.parent, name))
+                self._cache_body(prefetched, render(doc, ext),
+                                 prefetched=True)
+
+    def _stats_report(self):
+        """Returns content of stats.json: backend round trips and writes,
+        and hits of the document body cache.
+        """
+
+        report = collections.OrderedDict(
+            [("round_trips", self.backend.round_trips),
+             ("writes", self.backend.writes),
+             ("bodies", self.bodies.stats())])
+        if self.shared is not None:
+            report["shared"] = self.shared.stats()
+        return json.dumps(report, indent=4)
+
     def _find_doc(self, path):
         """Return mongo document found by given `path`.
         """
 
-        components = split_path(path)
-        assert len(components) >= 4
-
-        db = components[1]
-        coll = components[2]
-        oid = components[-1].split(".")[0]
+        node = resolve_path(path)
+        assert node.kind == Node.DOCUMENT
 
         # Database names cannot contain the character '.'
-        if "." in db:
+        if "." in node.db:
             return None
 
-        try:
-            return self.conn[db][coll].find_one(bson.objectid.ObjectId(oid))
+        if node.parent in self._pipelines:
+            stem = os.path.splitext(node.name)[0]
+            return (self._aggregate(node.parent) or {}).get(stem)
+
+        if node.oid is None:
+            return None
+
+        return self.backend.find_one(node.db, node.coll, node.oid)
+
+    def _aggregate(self, path):
+        """Returns ordered mapping of file names (see `result_names()`) to
+        documents produced by pipeline.json of `path` folder, or `None`
+        for malformed pipelines.
+        Results are reused for `pipeline_ttl` seconds.
+        """
 
-        except bson.errors.InvalidId:
+        node = resolve_path(path)
+        limit = self._get_limit(path)
+        try:
+            pipeline = loads(self._pipelines[node.path])
+        except ValueError:
+            return None
+        if not isinstance(pipeline, list) or limit is None:
             return None
 
-    def _save_doc(self, path, data):
-        """Saves mongo document.
+        key = (pipeline_key(node.db, node.coll, pipeline), limit)
+        results = self._pipeline_results.get(key)
+        if results is None:
+            if self.materialize_pipelines:
+                docs = self._materialize(node, pipeline, key[0], limit)
+            else:
+                docs = self.backend.aggregate(node.db, node.coll, pipeline,
+                                              limit=limit)
+            results = collections.OrderedDict(
+                zip(result_names(docs), docs))
+            self._pipeline_results[key] = results
+
+        return results
+
+    def _materialize(self, node, pipeline, key, limit):
+        """Returns first `limit` results of `pipeline` stored in a scratch
+        collection, running it with ``$out`` unless a run by any mount is
+        younger than `pipeline_ttl`.
         """
 
-        components = split_path(path)
-        dirs, fname = os.path.split(path)
-        assert len(components) >= 4
+        scratch = "{}.{}".format(PIPELINES_COLLECTION, key[:16])
+        info = self.backend.find_one(node.db, PIPELINES_COLLECTION, key)
+
+        if info is None or time.time() - info["created"] > self.pipeline_ttl:
+            db = self.conn[node.db]
+            self.backend.count_write()
+            db[node.coll].aggregate(pipeline + [{"$out": scratch}],
+                                    allowDiskUse=True,
+                                    cursor={})
+            self.backend.count_write()
+            db[PIPELINES_COLLECTION].save({"_id": key,
+                                           "created": time.time(),
+                                           "collection": node.coll,
+                                           "pipeline": query_key(pipeline)})
+
+        # Secondaries may not have replicated $out output yet
+        return self.backend.find(node.db, scratch, {}, limit=limit,
+                                 primary=True)
+
+    def _save_doc(self, path, data, fh=None):
+        """Saves mongo document written to open file `fh`.
+        """
 
-        db = components[1]
-        coll = components[2]
+        node = resolve_path(path)
+        assert node.depth >= 4
 
-        doc = loads(data)
+        if node.ext == ".bson":
+            if not bson.is_valid(data):
+                raise fuse.FuseOSError(errno.EINVAL)
+            doc = bson.BSON(data).decode()
+        else:
+            doc = loads(data)
 
         # If document doesn't have own _id field, but named like ObjectId,
         # use that id
-        if '_id' not in doc:
-            try:
-                doc['_id'] = bson.objectid.ObjectId(os.path.splitext(fname)[0])
-            except bson.errors.InvalidId:
-                pass
+        if '_id' not in doc and node.oid is not None:
+            doc['_id'] = node.oid
 
-        self.conn[db][coll].save(doc)
+        coll = self.conn[node.db][node.coll]
+        old = self._snapshots.get(fh, (None, 0))[0] if fh else None
 
-    def _remove_doc(self, path):
-        """Deletes mongo document. """
+        # Documents unknown to us (new ones, or never opened) are saved
+        # whole, as well as documents getting another _id
+        if old is None or '_id' not in doc or old['_id'] != doc['_id']:
+            self.backend.count_write()
+            coll.save(doc)
+
+        else:
+            to_set, to_unset, conditions = diff_document(old, doc)
+            if not to_set and not to_unset:
+                return
+
+            # Fields we change must still have values we've read,
+            # otherwise someone else changed the document meanwhile
+            spec = dict(conditions, _id=doc['_id'])
+            update = {}
+            if to_set:
+                update['$set'] = to_set
+            if to_unset:
+                update['$unset'] = to_unset
+
+            if len(bson.BSON.encode(update)) >= len(bson.BSON.encode(doc)):
+                update = doc
+
+            self.backend.count_write()
+            result = coll.update(spec, update)
+            if not result or not result.get('updatedExisting'):
+                log.warning("%s changed since it was opened, not saved", path)
+                raise fuse.FuseOSError(errno.ESTALE)
+
+        if fh:
+            self._keep_snapshot(fh, doc, len(data))
+
+    def _written(self, path, fh):
+        """Returns content of document file `path` as written to open file
+        `fh`: its current content until first written.
+        """
 
-        components = split_path(path)
-        assert len(components) >= 4
+        content = self._writes.get(fh)
+        if content is None:
+            node = resolve_path(path)
+            body = None
+            if node.kind == Node.DOCUMENT:
+                body = self._document_body(path)
+            content = bytearray(body or "")
+            self._writes[fh] = content
+        return content
+
+    def _flush_writes(self, path, fh):
+        """Saves document written to open file `fh`, if changed since last
+        saved.
+        """
 
-        db = components[1]
-        coll = components[2]
-        oid = components[-1].split(".")[0]
+        if fh not in self._unsaved:
+            return
+        self._unsaved.discard(fh)
 
         try:
-            self.conn[db][coll].remove(bson.objectid.ObjectId(oid))
+            self._save_doc(path, str(self._writes[fh]), fh)
+        except ValueError:
+            raise fuse.FuseOSError(errno.EINVAL)
+        finally:
+            self._invalidate(path)
+            self._drop_content(fh)
+
+    # Copies held per open file are counted against `bodies` budget. Content
+    # is only copied if it fits, and read from cache otherwise; snapshots
+    # are needed to save changes, and are always kept.
+
+    def _keep_content(self, fh, content):
+        self._drop_content(fh)
+        if self.bodies.reserve(len(content)):
+            self._handles[fh] = content
+
+    def _drop_content(self, fh):
+        content = self._handles.pop(fh, None)
+        if content is not None:
+            self.bodies.unreserve(len(content))
+
+    def _keep_snapshot(self, fh, doc, size):
+        self._drop_snapshot(fh)
+        self.bodies.reserve(size, force=True)
+        self._snapshots[fh] = (doc, size)
+
+    def _drop_snapshot(self, fh):
+        _, size = self._snapshots.pop(fh, (None, 0))
+        self.bodies.unreserve(size)
+
+    def _remove_doc(self, path):
+        """Deletes mongo document. """
+
+        node = resolve_path(path)
+        assert node.kind == Node.DOCUMENT
 
-        except bson.errors.InvalidId:
+        if node.oid is None:
             return False
 
-        else:
-            return True
+        self.backend.count_write()
+        self.conn[node.db][node.coll].remove(node.oid)
+        return True
+
+    def _is_unchanged(self, path, content):
+        """Returns `True` if document file at `path` has the same `content`
+        as on previous `open()`, so kernel may keep its cached pages.
+        `None` content is of created files, having no document until saved.
+        """
+
+        digest = hashlib.sha1(content or "").hexdigest()
+        previous = self._opened.get(path)
+        self._opened[path] = digest
+        return previous == digest
+
+    def _invalidate(self, path):
+        """Forgets everything cached about `path` after a known change.
+        """
+
+        node = resolve_path(path)
+
+        # Document is shown in files of every extension
+        paths = [path]
+        if node.kind == Node.DOCUMENT:
+            stem = os.path.splitext(path)[0]
+            paths = [stem + ext for ext in DOCUMENT_EXTENSIONS]
+        for changed in paths:
+            self.attrs_cache.pop(changed)
+            self._opened.pop(changed)
+
+        for ext in DOCUMENT_EXTENSIONS:
+            key = body_key(node._replace(ext=ext))
+            self.bodies.pop(key)
+            if self.shared is not None:
+                self.shared.pop(key)
 
     def _get_query(self, path):
         """Returns query defined for `path`, or `{}` if query not defined.
@@ -344,92 +1150,1524 @@ class MongoFuse(LoggingMixIn, Operations):
         parameter placeholders.
         """
 
+        node = resolve_path(path)
 
-        components = split_path(path)
-        dirname = components[-1]
-
-        if path not in self._queries:
+        if node.path not in self._queries:
             # Search parent's query.json and use subfolder name as query param
             # TODO: way to escape substitutions
-            # TODO: detect int/string substitutions
-            parent_path = os.path.join(*components[:-1])
-            query = self._queries.get(parent_path, "{}")
-            query = query.replace("$1", dirname)
+            template = self._compile(node, self._queries.get(node.parent, "{}"))
+            param = node.name
 
         else:
-            query = self._queries.get(path, '{}')
+            template = self._compile(node, self._queries[node.path])
+            param = None
 
             # Treat unresolved substituions as malformed query
-            if '$1' in query:
+            if template and template.placeholders:
                 return None
 
-        try:
-            return loads(query)
+        if not template:
+            return None
+        return template.bind(param)
+
+    def _compile(self, node, text):
+        """Returns `QueryTemplate` compiled from query.json `text` for
+        collection of `node`, or `False` if malformed. Templates are
+        compiled once, with placeholder types inferred from a document
+        having the placeholder's field. While collection has no such
+        document, they're compiled again on every use.
+        """
 
+        key = (node.db, node.coll, text)
+        template = self._templates.get(key)
+        if template is not None:
+            return template
+
+        inferred = True
+        try:
+            template = QueryTemplate(text)
         except ValueError:
-            return None
+            template = False
+        else:
+            for placeholder in template.placeholders:
+                if not placeholder.field or not node.coll or \
+                        placeholder.pattern not in (None, "$1") or \
+                        not self._allow_sample(node, placeholder.field):
+                    continue
+                sample = self.backend.find(
+                    node.db, node.coll,
+                    {placeholder.field: {"$exists": True}}, limit=1)
+                if sample:
+                    placeholder.infer(
+                        field_value(sample[0], placeholder.field))
+                else:
+                    inferred = False
 
+        if inferred:
+            self._templates[key] = template
+        return template
 
-class LRUCache(dict):
-    """Simple Least Recently Used (LRU) cache.
+    def _allow_sample(self, node, field):
+        """Returns `False` if looking up a document having `field` in
+        collection of `node` would scan more than `collscan_limit`
+        documents, and the guard refuses such scans.
+        """
 
-    Removes contained items after `expire_secs` seconds.
+        if not self.collscan_limit:
+            return True
 
-    """
+        stats = self._stats(node.db, "collstats", node.coll)
+        if stats.get("count", 0) <= self.collscan_limit:
+            return True
 
-    def __init__(self, expire_secs=2):
-        self.expire_secs = expire_secs
-        self._time_added = {}
+        indexes = self.backend.index_information(node.db, node.coll)
+        if any(list(info["key"])[0][0] == field
+               for info in indexes.values()):
+            return True
 
-    def __setitem__(self, key, value):
-        self._delete_expired()
-        self._time_added[key] = time.time()
-        dict.__setitem__(self, key, value)
+        log.warning("Inferring type of %s scans whole %s.%s of %d "
+                    "documents%s", field, node.db, node.coll, stats["count"],
+                    ", refused" if self.collscan_action == "refuse" else "")
+        return self.collscan_action != "refuse"
 
-    def __getitem__(self, key):
-        self._delete_expired()
-        return dict.__getitem__(self, key)
+    def _get_sort(self, path):
+        """Returns list of ``(field, direction)`` pairs from sort.json of
+        `path` or its parent, `[]` if not defined, or `None` if malformed.
+        """
 
-    def __contains__(self, key):
-        self._delete_expired()
-        return dict.__contains__(self, key)
+        content = self._get_control(self._sorts, path, "{}")
+        try:
+            spec = json.loads(content, object_pairs_hook=collections.OrderedDict)
+        except ValueError:
+            return None
 
-    def __len__(self):
-        self._delete_expired()
-        return dict.__len__(self)
-    
-    def _delete_expired(self):
-        now = time.time()
-        for key, added in self._time_added.items():
-            if now - added > self.expire_secs:
-                del self[key]
-                del self._time_added[key]
+        if isinstance(spec, dict):
+            spec = spec.items()
+        try:
+            sort = [(str(field), int(direction)) for field, direction in spec]
+        except (TypeError, ValueError):
+            return None
 
+        if any(direction not in (1, -1) for field, direction in sort):
+            return None
+        return sort
 
-def split_path(path):
-    """Split `path` into list of components.
-    """
-    
-    head, tail = os.path.split(os.path.normpath(path))
-    if tail:
-        return split_path(head) + [tail]
+    def _get_limit(self, path):
+        """Returns number of documents to list in `path`, or `None` if
+        limit file is malformed. Zero is malformed too: for MongoDB it
+        means no limit, which would list the whole collection.
+        """
 
-    else:
-        return [head]
+        content = self._get_control(self._limits, path, str(DEFAULT_LIMIT))
+        try:
+            limit = int(content.strip())
+        except ValueError:
+            return None
+        return limit if limit >= 1 else None
 
+    def _get_control(self, contents, path, default):
+        """Returns content of control file in `path`, or in its parent
+        folder, or `default`.
+        """
 
-def dumps(doc):
+        node = resolve_path(path)
+        if node.path in contents:
+            return contents[node.path]
+        return contents.get(node.parent, default)
 
-    return json.dumps(doc,
-                      indent=4,
+    def _check_sort(self, node, query, sort):
+        """Warns when server would have to sort listing of `node` in memory.
+        """
+
+        key = (node.db, node.coll, query_key(sorted(query)), tuple(sort))
+        if key in self._checked_sorts:
+            return
+        self._checked_sorts[key] = True
+
+        indexes = self.backend.index_information(node.db, node.coll)
+        if not sort_uses_index(indexes, query, sort):
+            log.warning("No index serves sort %s of %s.%s with query %s, "
+                        "server will sort in memory",
+                        sort, node.db, node.coll, query_key(query))
+
+
+class Backend(object):
+    """Read access to MongoDB which merges concurrent identical requests.
+
+    FUSE runs operations in many threads, and parallel tools often ask for
+    the same listing or document at the same moment. While a request is in
+    flight, identical requests wait for its result instead of repeating
+    it, and `find_one()` calls for one collection are batched into a
+    single ``$in`` query.
+
+    ``connect``
+        Callable returning MongoDB connection.
+
+    ``read_preference``
+        Name of read preference for documents and listings, one of
+        `READ_PREFERENCES`. `None` reads from the primary.
+
+    ``max_staleness``
+        Seconds secondaries may lag behind the primary. When any of them
+        lags more, documents are read from the primary.
+
+    Requests made are counted in `round_trips`. Writes go to the primary
+    connection directly, and are counted in `writes` with `count_write()`.
+
+    """
+
+    # Seconds to reuse measured replication lag
+    LAG_CHECK_SECS = 10
+
+    def __init__(self, connect, read_preference=None, max_staleness=None):
+        self._connect = connect
+        self.read_preference = read_preference
+        self.max_staleness = max_staleness
+        self._lag = None
+        self._lag_checked = 0
+        self._flights = SingleFlight()
+        self._batches = {}                                # (db, coll) => batch
+        self._busy = collections.defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+        self.round_trips = 0
+        self.writes = 0
+
+    def count_write(self):
+        """Counts a write made outside of the backend."""
+
+        with self._lock:
+            self.writes += 1
+
+    def database_names(self):
+        options = self.read_options()
+
+        def database_names(conn):
+            if not options:
+                return conn.database_names()
+            result = self._read_command(conn, "admin", "listDatabases",
+                                        options)
+            return [info["name"] for info in result["databases"]]
+
+        return self._flights.do(("databases",), self._call, database_names)
+
+    def collection_names(self, db):
+        options = self.read_options()
+
+        def collection_names(conn):
+            if options:
+                try:
+                    result = self._read_command(
+                        conn, db,
+                        bson.son.SON([("listCollections", 1), ("cursor", {})]),
+                        options)
+                except pymongo.errors.OperationFailure:
+                    # Servers before 3.0 list collections in system.namespaces
+                    pass
+                else:
+                    return [info["name"]
+                            for info in result["cursor"]["firstBatch"]]
+            return conn[db].collection_names()
+
+        return self._flights.do(("collections", db), self._call,
+                                collection_names)
+
+    def find(self, db, coll, query, sort=None, limit=0, primary=False):
+        """Returns list of documents matching `query`, sorted by list of
+        ``(field, direction)`` pairs `sort`. Read from the primary if
+        `primary` is `True`, else according to read preference.
+        """
+
+        options = {} if primary else self.read_options()
+
+        def find(conn):
+            cursor = conn[db][coll].find(query, **options)
+            if sort:
+                cursor = cursor.sort(sort)
+            return list(cursor.limit(limit))
+
+        key = ("find", db, coll, query_key(query), query_key(sort), limit,
+               primary)
+        return self._flights.do(key, self._call, find)
+
+    def aggregate(self, db, coll, pipeline, limit=0):
+        """Returns first `limit` results of aggregation `pipeline`, streamed
+        through a cursor. Server may use disk for large stages.
+        """
+
+        options = self.read_options()
+
+        def aggregate(conn):
+            cursor = conn[db][coll].aggregate(pipeline,
+                                              allowDiskUse=True,
+                                              cursor={},
+                                              **options)
+            return list(itertools.islice(cursor, limit or None))
+
+        key = ("aggregate", db, coll, query_key(pipeline), limit)
+        return self._flights.do(key, self._call, aggregate)
+
+    def command(self, db, command, arg=1):
+        """Returns result of read-only `command`, such as ``collstats``."""
+
+        options = self.read_options()
+        return self._flights.do(
+                ("command", db, command, arg),
+                self._call,
+                lambda conn: conn[db].command(command, arg, **options))
+
+    def explain(self, db, coll, query, sort=None, limit=0,
+                verbosity="queryPlanner"):
+        """Returns server's explanation of how it runs `find()` with given
+        arguments. With ``executionStats`` `verbosity` the query is run.
+        """
+
+        options = self.read_options()
+
+        def explain_cursor(conn):
+            cursor = conn[db][coll].find(query, **options).limit(limit)
+            if sort:
+                cursor = cursor.sort(sort)
+            return cursor.explain()
+
+        def explain(conn):
+            find = bson.son.SON([("find", coll), ("filter", query)])
+            if sort:
+                find["sort"] = bson.son.SON(sort)
+            if limit:
+                find["limit"] = limit
+            try:
+                # pymongo sends explain command to the primary
+                if options:
+                    command = bson.son.SON([("explain", find),
+                                            ("verbosity", verbosity)])
+                    return self._read_command(conn, db, command, options)
+                return conn[db].command("explain", find, verbosity=verbosity)
+            except pymongo.errors.OperationFailure:
+                # Servers before 3.0 only explain cursors
+                return explain_cursor(conn)
+
+        key = ("explain", db, coll, query_key(query), query_key(sort), limit,
+               verbosity)
+        return self._flights.do(key, self._call, explain)
+
+    def index_information(self, db, coll):
+        return self._flights.do(("indexes", db, coll),
+                                self._call,
+                                lambda conn: conn[db][coll].index_information())
+
+    def find_one(self, db, coll, oid):
+        """Returns document with `oid` id, or `None`."""
+
+        key = (db, coll)
+
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._batches[key] = _Batch()
+            batch.oids.add(oid)
+
+        if leader:
+            # Requests arriving while previous batch of this collection is
+            # in flight join our batch
+            with self._busy[key]:
+                with self._lock:
+                    del self._batches[key]
+                try:
+                    query = {"_id": {"$in": list(batch.oids)}}
+                    options = self.read_options()
+                    docs = self._call(
+                        lambda conn: conn[db][coll].find(query, **options))
+                    batch.result = dict((doc["_id"], doc) for doc in docs)
+                except Exception as e:
+                    batch.error = e
+                finally:
+                    batch.done.set()
+
+        return batch.wait().get(oid)
+
+    def read_options(self):
+        """Returns keyword arguments routing a `find()` according to read
+        preference and staleness limit.
+        """
+
+        if self.read_preference is None:
+            return {}
+
+        name = READ_PREFERENCES[self.read_preference]
+        if self.max_staleness is not None and name != "PRIMARY":
+            lag = self.replication_lag()
+            if lag is None or lag > self.max_staleness:
+                name = "PRIMARY"
+
+        return dict(read_preference=getattr(pymongo.ReadPreference, name))
+
+    def replication_lag(self):
+        """Returns seconds the most lagging secondary is behind the primary,
+        or `None` if unknown. Measured at most every `LAG_CHECK_SECS`.
+        """
+
+        now = time.time()
+        if now - self._lag_checked > self.LAG_CHECK_SECS:
+            self._lag_checked = now
+            try:
+                status, config = self._call(replica_set_status)
+            except pymongo.errors.OperationFailure as e:
+                log.warning("Can't measure replication lag: %s", e)
+                self._lag = None
+            else:
+                self._lag = replication_lag(status, config)
+        return self._lag
+
+    def _read_command(self, conn, db, command, options):
+        """Returns result of read-only `command`, routed by read `options`.
+        pymongo sends commands it doesn't know to be read-only, such as
+        ``listCollections``, to the primary, so `command` is sent as a
+        query of ``$cmd`` collection instead.
+        """
+
+        if isinstance(command, basestring):
+            command = {command: 1}
+        result = conn[db]["$cmd"].find_one(command, **options)
+        if not result or not result.get("ok"):
+            raise pymongo.errors.OperationFailure(
+                (result or {}).get("errmsg", "%s failed" % command.keys()[0]))
+        return result
+
+    def _call(self, func):
+        with self._lock:
+            self.round_trips += 1
+        return func(self._connect())
+
+
+class _Call(object):
+    """Result of a call shared between threads."""
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _Batch(_Call):
+
+    def __init__(self):
+        _Call.__init__(self)
+        self.oids = set()
+
+
+class SingleFlight(object):
+    """Runs one call per key at a time; concurrent callers with the same key
+    get the result of the call already in flight.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            try:
+                call.result = func(*args)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        return call.wait()
+
+
+class QueryTemplate(object):
+    """Query compiled from query.json text with ``$1`` placeholders.
+
+    Placeholder may stand for a JSON value (``{"age": $1}``), or be a part
+    of a string (``{"name": "$1"}``, ``{"code": "item-$1"}``). `bind()`
+    substitutes parameter converted to placeholder's type, so that query
+    values have the type of the field's values.
+
+    Raises `ValueError` for malformed text.
+
+    """
+
+    MARKER = "$mongofuse_param"
+
+    def __init__(self, text):
+        self.placeholders = []
+        self.query = self._compile(loads(self._mark(text)), None, False)
+        if not isinstance(self.query, dict):
+            raise ValueError("Query must be an object")
+
+    def bind(self, param):
+        """Returns query with placeholders substituted for `param`, or
+        `None` if `param` can't be converted to their types.
+        """
+
+        try:
+            return self._bind(self.query, param)
+        except ValueError:
+            return None
+
+    def _mark(self, text):
+        """Replaces placeholders outside of strings with marker objects,
+        so that text can be parsed as JSON.
+        """
+
+        parts = []
+        in_string = escaped = False
+        i = 0
+        while i < len(text):
+            char = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif text.startswith("$1", i):
+                parts.append('{"%s": 0}' % self.MARKER)
+                i += 2
+                continue
+            parts.append(char)
+            i += 1
+        return "".join(parts)
+
+    def _compile(self, value, field, direct):
+
+        if isinstance(value, dict) and value.keys() == [self.MARKER]:
+            placeholder = Placeholder(field, direct=direct)
+
+        elif isinstance(value, basestring) and "$1" in value:
+            placeholder = Placeholder(field, direct=direct, pattern=value)
+
+        elif isinstance(value, dict):
+            compiled = {}
+            for key, item in value.items():
+                if key.startswith("$"):
+                    compiled[key] = self._compile(item, field, False)
+                else:
+                    path = key if field is None else field + "." + key
+                    compiled[key] = self._compile(item, path, field is None)
+            return compiled
+
+        elif isinstance(value, list):
+            return [self._compile(item, field, False) for item in value]
+
+        else:
+            return value
+
+        self.placeholders.append(placeholder)
+        return placeholder
+
+    def _bind(self, value, param):
+
+        if isinstance(value, Placeholder):
+            return value.bind(param)
+        elif isinstance(value, dict):
+            return dict((key, self._bind(item, param))
+                        for key, item in value.items())
+        elif isinstance(value, list):
+            return [self._bind(item, param) for item in value]
+        else:
+            return value
+
+
+class Placeholder(object):
+    """``$1`` placeholder of `QueryTemplate`.
+
+    ``field``
+        Dotted path of the field compared with placeholder's value.
+
+    ``direct``
+        `True` if placeholder is the field's value, not an operand.
+
+    ``pattern``
+        String placeholder is a part of, or `None`.
+
+    ``type``
+        One of `Placeholder.TYPES` names, or `None` until inferred with
+        `infer()`: then values looking like JSON numbers, booleans or
+        null are bound as such, and others as strings.
+
+    """
+
+    DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f")
+
+    def __init__(self, field, direct=False, pattern=None):
+        self.field = field
+        self.direct = direct
+        self.pattern = pattern
+        self.type = None
+
+    def infer(self, sample):
+        """Sets placeholder's type to the one of field value `sample`."""
+
+        if self.pattern not in (None, "$1"):
+            self.type = "str"
+        elif isinstance(sample, bool):
+            self.type = "bool"
+        elif isinstance(sample, (int, long)):
+            self.type = "int"
+        elif isinstance(sample, float):
+            self.type = "float"
+        elif isinstance(sample, bson.objectid.ObjectId):
+            self.type = "oid"
+        elif isinstance(sample, datetime.datetime):
+            self.type = "date"
+        elif isinstance(sample, basestring):
+            self.type = "str"
+
+    def bind(self, param):
+        """Returns `param` converted to placeholder's type. Raises
+        `ValueError` if it can't be converted.
+        """
+
+        if self.pattern is not None and self.pattern != "$1":
+            return self.pattern.replace("$1", param)
+
+        if self.type == "str":
+            return param
+        elif self.type == "int":
+            return int(param)
+        elif self.type == "float":
+            return float(param)
+        elif self.type == "bool":
+            if param not in ("true", "false"):
+                raise ValueError(param)
+            return param == "true"
+        elif self.type == "oid":
+            if not bson.objectid.ObjectId.is_valid(param):
+                raise ValueError(param)
+            return bson.objectid.ObjectId(param)
+        elif self.type == "date":
+            return self._bind_date(param)
+
+        # Unknown type: quoted placeholders are strings, others may be
+        # any JSON scalar
+        if self.pattern is None:
+            try:
+                value = json.loads(param)
+            except ValueError:
+                pass
+            else:
+                if value is None or isinstance(value, (bool, int, long, float)):
+                    return value
+        return param
+
+    def _bind_date(self, param):
+        """Returns datetime from ISO formatted `param`. A date alone, as
+        the field's value, matches the whole day.
+        """
+
+        for fmt in self.DATE_FORMATS:
+            try:
+                value = datetime.datetime.strptime(param, fmt)
+            except ValueError:
+                continue
+            if fmt == "%Y-%m-%d" and self.direct:
+                return {"$gte": value,
+                        "$lt": value + datetime.timedelta(days=1)}
+            return value
+        raise ValueError(param)
+
+
+class Node(collections.namedtuple("Node",
+                                  "kind path parent name depth db coll oid "
+                                  "ext")):
+    """File system entry parsed from a path by `resolve_path()`.
+
+    ``kind``
+        One of ``Node.ROOT``, ``Node.DATABASE``, ``Node.COLLECTION``,
+        ``Node.VIEW``, ``Node.DOCUMENT``, ``Node.STATS``, or a kind of
+        `Node.CONTROL_FILES`.
+
+    ``path``, ``parent``, ``name``
+        Normalized path, its directory and its last component.
+
+    ``depth``
+        Number of path components, root included.
+
+    ``db``, ``coll``
+        Database and collection names, `None` above those levels.
+
+    ``oid``
+        `ObjectId` named by a document file, or `None`.
+
+    ``ext``
+        Extension of a document file, selecting its representation.
+
+    """
+
+    ROOT = "root"
+    DATABASE = "database"
+    COLLECTION = "collection"
+    VIEW = "view"
+    DOCUMENT = "document"
+    QUERY = "query"
+    SORT = "sort"
+    LIMIT = "limit"
+    PIPELINE = "pipeline"
+    EXPLAIN = "explain"
+    NEW = "new"
+    STATS = "stats"
+
+    # Special files found in collection and view folders
+    CONTROL_FILES = {"query.json": QUERY,
+                     "sort.json": SORT,
+                     "limit": LIMIT,
+                     "pipeline.json": PIPELINE,
+                     "explain.json": EXPLAIN,
+                     "new.json": NEW}
+
+    # Content of newly created control files
+    CONTROL_DEFAULTS = {QUERY: "{}",
+                        SORT: "{}",
+                        LIMIT: str(DEFAULT_LIMIT),
+                        PIPELINE: "[]"}
+
+
+class BoundedCache(object):
+    """Thread-safe mapping which keeps `max_size` most recently used items.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class LRUCache(dict):
+    """Simple Least Recently Used (LRU) cache.
+
+    Removes contained items after `expire_secs` seconds. Thread-safe;
+    deleting a missing key does nothing.
+
+    """
+
+    def __init__(self, expire_secs=2):
+        self.expire_secs = expire_secs
+        self._time_added = {}
+        self._lock = threading.RLock()
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._delete_expired()
+            self._time_added[key] = time.time()
+            dict.__setitem__(self, key, value)
+
+    def __getitem__(self, key):
+        with self._lock:
+            self._delete_expired()
+            return dict.__getitem__(self, key)
+
+    def __delitem__(self, key):
+        self.pop(key, None)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self._time_added.pop(key, None)
+            return dict.pop(self, key, default)
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._delete_expired()
+            return dict.get(self, key, default)
+
+    def clear(self):
+        with self._lock:
+            dict.clear(self)
+            self._time_added.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            self._delete_expired()
+            return dict.__contains__(self, key)
+
+    def __len__(self):
+        with self._lock:
+            self._delete_expired()
+            return dict.__len__(self)
+
+    def _delete_expired(self):
+        now = time.time()
+        for key, added in self._time_added.items():
+            if now - added > self.expire_secs:
+                self.pop(key)
+
+
+class BodyCache(object):
+    """Thread-safe cache of document file contents, expiring entries after
+    `ttl` seconds.
+
+    Keeps most recently used entries within `max_bytes` of memory.
+    Contents of `compress_min` bytes or more are stored compressed with
+    `codec`, one of `CODECS` names. Entries read `pin_after` times are
+    pinned: up to `max_pinned` of them are kept apart from the others, so
+    that scans through many documents don't evict them. Memory held
+    elsewhere for cached documents can be counted against `max_bytes` with
+    `reserve()`.
+
+    """
+
+    # Number of keys whose reads are counted for pinning
+    MAX_READS = 65536
+
+    def __init__(self, ttl=2, max_bytes=64 << 20, max_pinned=256,
+                 pin_after=4, codec="zlib", compress_min=1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_pinned = max_pinned
+        self.pin_after = pin_after
+        self.compress_min = compress_min
+        self._codec = None
+        if CODECS[codec] is not None:
+            self._codec = importlib.import_module(CODECS[codec])
+        self._entries = collections.OrderedDict()  # key => _Body
+        self._pinned = collections.OrderedDict()   # key => _Body
+        self._reads = collections.OrderedDict()    # key => number of reads
+        self._bytes = 0
+        self._raw_bytes = 0
+        self._held = 0
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+
+    def get(self, key):
+        """Returns content cached under `key`, or `None`."""
+
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                return None
+
+        if entry.compressed:
+            return self._codec.decompress(entry.data)
+        return entry.data
+
+    def size(self, key):
+        """Returns length of content cached under `key`, or `None`. Counted
+        as a read, but content isn't decompressed.
+        """
+
+        with self._lock:
+            entry = self._lookup(key)
+            return entry.size if entry is not None else None
+
+    def put(self, key, body, prefetched=False):
+        """Caches `body` under `key`. `prefetched` bodies are counted as
+        read-ahead.
+        """
+
+        compressed = self._codec is not None and \
+                     len(body) >= self.compress_min
+        data = self._codec.compress(body) if compressed else body
+        entry = _Body(data, len(body), compressed, prefetched)
+
+        with self._lock:
+            if prefetched:
+                self._counters["readahead"] += 1
+            pinned = key in self._pinned or \
+                     self._reads.get(key, 0) >= self.pin_after
+            self._remove(key)
+            self._add(key, entry, pinned)
+
+    def pop(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def reserve(self, size, force=False):
+        """Counts `size` bytes held outside the cache against `max_bytes`,
+        evicting entries to make room. Returns `False`, reserving nothing,
+        if they don't fit even in an empty cache, unless `force` is set.
+        """
+
+        with self._lock:
+            if not force and self._held + size > self.max_bytes:
+                return False
+            self._held += size
+            self._evict()
+            return True
+
+    def unreserve(self, size):
+        """Returns `size` bytes counted by `reserve()` to the cache."""
+
+        with self._lock:
+            self._held -= size
+
+    def is_fresh(self, key):
+        """Returns `True` if content under `key` is cached and not expired.
+        Not counted as a read.
+        """
+
+        with self._lock:
+            entry = self._pinned.get(key) or self._entries.get(key)
+            return entry is not None and time.time() - entry.added <= self.ttl
+
+    def stats(self):
+        """Returns counters of cache usage."""
+
+        with self._lock:
+            stats = collections.OrderedDict()
+            for name in ("hits", "misses", "pinned_hits", "readahead",
+                         "readahead_hits"):
+                stats[name] = self._counters[name]
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = round(float(stats["hits"]) / lookups, 4) \
+                                if lookups else None
+            stats["entries"] = len(self._entries)
+            stats["pinned"] = len(self._pinned)
+            stats["bytes"] = self._bytes
+            stats["uncompressed_bytes"] = self._raw_bytes
+            stats["held_bytes"] = self._held
+            return stats
+
+    def _lookup(self, key):
+        """Returns fresh entry of `key`, counting the read."""
+
+        reads = self._reads.pop(key, 0) + 1
+        self._reads[key] = reads
+        if len(self._reads) > self.MAX_READS:
+            self._reads.popitem(last=False)
+
+        pinned = key in self._pinned
+        entry = self._remove(key)
+        if entry is None or time.time() - entry.added > self.ttl:
+            self._counters["misses"] += 1
+            return None
+
+        self._counters["hits"] += 1
+        if pinned:
+            self._counters["pinned_hits"] += 1
+        if entry.prefetched:
+            self._counters["readahead_hits"] += 1
+            entry.prefetched = False
+
+        self._add(key, entry, pinned or reads >= self.pin_after)
+        return entry
+
+    def _add(self, key, entry, pinned):
+        if pinned:
+            self._pinned[key] = entry
+            if len(self._pinned) > self.max_pinned:
+                # Least recently read pinned entry competes with others again
+                old_key, old_entry = self._pinned.popitem(last=False)
+                self._entries[old_key] = old_entry
+        else:
+            self._entries[key] = entry
+
+        self._bytes += len(entry.data)
+        self._raw_bytes += entry.size
+        self._evict()
+
+    def _evict(self):
+        while self._bytes + self._held > self.max_bytes and \
+                (self._entries or self._pinned):
+            entries = self._entries or self._pinned
+            old_key, old_entry = entries.popitem(last=False)
+            self._bytes -= len(old_entry.data)
+            self._raw_bytes -= old_entry.size
+
+    def _remove(self, key):
+        entry = self._pinned.pop(key, None) or self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry.data)
+            self._raw_bytes -= entry.size
+        return entry
+
+
+class _Body(object):
+    """Content cached by `BodyCache`."""
+
+    __slots__ = ("data", "size", "compressed", "prefetched", "added")
+
+    def __init__(self, data, size, compressed, prefetched):
+        self.data = data
+        self.size = size
+        self.compressed = compressed
+        self.prefetched = prefetched
+        self.added = time.time()
+
+
+class SharedCache(object):
+    """Cache of document file contents shared by processes of one host,
+    kept in memory-mapped file `path` of `size` bytes.
+
+    File is an array of fixed `slot_size` slots, each holding one entry:
+    key is hashed to its slot, and an entry stored there replaces the
+    previous one. Contents of `compress_min` bytes or more are stored
+    zlib-compressed; larger ones than fit in a slot aren't cached.
+
+    Entries are versioned: writers, serialized with a lock of the slot,
+    make the version odd while changing an entry. Readers take no locks,
+    and use a copy of the entry only if the version was the same even
+    number before and after copying. Entries expire `ttl` seconds after
+    they're stored. Keys are hashed together with `namespace`, so caches
+    of different namespaces can share a file without seeing each other's
+    entries.
+
+    Slot geometry of an existing file is kept, whatever the arguments.
+
+    """
+
+    MAGIC = "MFUSESC1"
+    HEADER = struct.Struct("<8sII")
+    # Version, key digest, time stored, content length, flags
+    SLOT = struct.Struct("<Q20sdIB")
+    VERSION = struct.Struct("<Q")
+    COMPRESSED = 1
+    # Attempts to read an entry being changed
+    RETRIES = 3
+
+    def __init__(self, path, size=64 << 20, slot_size=16 << 10, ttl=2,
+                 compress_min=1024, namespace=()):
+        self.path = path
+        self.ttl = ttl
+        self.namespace = tuple(namespace)
+        self.compress_min = compress_min
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0660)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.read(self._fd, self.HEADER.size)
+            if len(header) == self.HEADER.size and \
+                    header.startswith(self.MAGIC):
+                magic, self.slots, self.slot_size = \
+                        self.HEADER.unpack(header)
+            else:
+                self.slot_size = slot_size
+                self.slots = max(1, size // slot_size)
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd,
+                             self.slot_size * (self.slots + 1))
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, self.HEADER.pack(self.MAGIC, self.slots,
+                                                    self.slot_size))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+        # First slot is taken by the header
+        self._map = mmap.mmap(self._fd, self.slot_size * (self.slots + 1))
+        self.capacity = self.slot_size - self.SLOT.size
+
+    def get(self, key):
+        """Returns content cached under `key` by any process, or `None`."""
+
+        digest, offset = self._locate(key)
+        start = offset + self.SLOT.size
+
+        for attempt in range(self.RETRIES):
+            version, found, stored, length, flags = \
+                    self.SLOT.unpack_from(self._map, offset)
+            if found != digest:
+                break
+            if version & 1:
+                continue
+            data = self._map[start:start + min(length, self.capacity)]
+            if self.VERSION.unpack_from(self._map, offset)[0] != version:
+                continue
+            if time.time() - stored > self.ttl:
+                break
+            self._counters["hits"] += 1
+            if flags & self.COMPRESSED:
+                return zlib.decompress(data)
+            return data
+
+        self._counters["misses"] += 1
+        return None
+
+    def put(self, key, body):
+        """Caches `body` under `key` for all processes."""
+
+        flags = 0
+        data = body
+        if len(body) >= self.compress_min:
+            data = zlib.compress(body)
+            flags |= self.COMPRESSED
+        if len(data) > self.capacity:
+            self._counters["too_large"] += 1
+            return
+
+        self._write(key, data, flags)
+        self._counters["stores"] += 1
+
+    def pop(self, key):
+        """Drops entry of `key`, if still cached."""
+
+        digest, offset = self._locate(key)
+        if self.SLOT.unpack_from(self._map, offset)[1] == digest:
+            self._write(key, "", 0, digest="\0" * 20)
+
+    def stats(self):
+        """Returns counters of this process' cache usage."""
+
+        stats = collections.OrderedDict()
+        for name in ("hits", "misses", "stores", "too_large"):
+            stats[name] = self._counters[name]
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(float(stats["hits"]) / lookups, 4) \
+                            if lookups else None
+        return stats
+
+    def _locate(self, key):
+        """Returns digest of `key`, and offset of its slot."""
+
+        parts = self.namespace + tuple(key)
+        digest = hashlib.sha1("\0".join(map(str, parts))).digest()
+        slot = struct.unpack_from("<Q", digest)[0] % self.slots
+        return digest, self.slot_size * (slot + 1)
+
+    def _write(self, key, data, flags, digest=None):
+
+        found, offset = self._locate(key)
+        digest = found if digest is None else digest
+
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                version = self.VERSION.unpack_from(self._map, offset)[0]
+                version = (version | 1) + 2
+                self.VERSION.pack_into(self._map, offset, version)
+                start = offset + self.SLOT.size
+                self._map[start:start + len(data)] = data
+                self.SLOT.pack_into(self._map, offset, version, digest,
+                                    time.time(), len(data), flags)
+                self.VERSION.pack_into(self._map, offset, version + 1)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+
+class ReadAhead(object):
+    """Detects documents of a folder being read in listing order, and tells
+    which ones to fetch ahead of time.
+
+    Window of documents to fetch starts at `min_window` and doubles with
+    every next document read in order, up to `max_window`. Reading any
+    other document resets it.
+
+    """
+
+    def __init__(self, min_window=2, max_window=32):
+        self.min_window = min_window
+        self.max_window = max_window
+        self._listings = BoundedCache(max_size=1024)  # folder => [names]
+        self._streams = BoundedCache(max_size=1024)   # folder => _Stream
+
+    def listed(self, folder, names):
+        """Remembers listing order of document `names` in `folder`."""
+
+        if self.max_window:
+            self._listings[folder] = (names, dict((name, i) for i, name
+                                                  in enumerate(names)))
+
+    def accessed(self, folder, name):
+        """Records access to document `name` in `folder`. Returns list of
+        names of documents to fetch, maybe empty.
+        """
+
+        listing = self._listings.get(folder)
+        if listing is None or name not in listing[1]:
+            return []
+        names, positions = listing
+        position = positions[name]
+
+        stream = self._streams.get(folder)
+        if stream is None:
+            stream = self._streams[folder] = _Stream()
+
+        with stream.lock:
+            # Same document again, e.g. getattr() followed by read()
+            if position == stream.position:
+                return []
+
+            if position == stream.position + 1:
+                stream.window = min(max(stream.window * 2, self.min_window),
+                                    self.max_window)
+            else:
+                stream.window = 0
+                stream.fetched = position
+            stream.position = position
+
+            start = max(stream.fetched, position) + 1
+            end = min(position + stream.window, len(names) - 1)
+            if end < start:
+                return []
+            stream.fetched = end
+            return names[start:end + 1]
+
+
+class _Stream(object):
+    """Sequential reading of a folder tracked by `ReadAhead`."""
+
+    def __init__(self):
+        self.position = -2
+        self.window = 0
+        self.fetched = -1
+        self.lock = threading.Lock()
+
+
+_resolved_paths = BoundedCache(max_size=4096)
+
+
+def resolve_path(path):
+    """Returns `Node` for `path`. Results are memoized, so that each path
+    is parsed once however many operations touch it.
+    """
+
+    node = _resolved_paths.get(path)
+    if node is None:
+        node = _parse_path(path)
+        _resolved_paths[path] = node
+    return node
+
+
+def _parse_path(path):
+
+    components = split_path(path)
+    depth = len(components)
+    path = os.path.join(*components)
+    parent, name = os.path.split(path)
+    db = components[1] if depth > 1 else None
+    coll = components[2] if depth > 2 else None
+    oid = None
+
+    if depth == 1:
+        kind = Node.ROOT
+    # Database names cannot contain the character '.'
+    elif depth == 2 and name == "stats.json":
+        kind = Node.STATS
+    elif depth == 2:
+        kind = Node.DATABASE
+    elif depth == 3:
+        kind = Node.COLLECTION
+    elif name in Node.CONTROL_FILES:
+        kind = Node.CONTROL_FILES[name]
+    else:
+        stem, ext = os.path.splitext(name)
+        if len(stem) == 24 and bson.objectid.ObjectId.is_valid(stem):
+            oid = bson.objectid.ObjectId(stem)
+        if oid is not None or ext in DOCUMENT_EXTENSIONS:
+            kind = Node.DOCUMENT
+        else:
+            kind = Node.VIEW
+
+    if kind != Node.DOCUMENT:
+        ext = ""
+
+    return Node(kind, path, parent, name, depth, db, coll, oid, ext)
+
+
+def split_path(path):
+    """Split `path` into list of components.
+    """
+    
+    head, tail = os.path.split(os.path.normpath(path))
+    if tail:
+        return split_path(head) + [tail]
+
+    else:
+        return [head]
+
+
+def file_handle(fh):
+    """Returns number of open file `fh`, passed as a number or, in raw_fi
+    mode, as fuse_file_info.
+    """
+
+    return getattr(fh, "fh", fh)
+
+
+def body_key(node):
+    """Returns key of document file `node` content in `BodyCache`: same
+    for the document in every folder of its collection.
+    """
+
+    return (node.db, node.coll, node.oid, node.ext)
+
+
+def result_names(docs):
+    """Returns list of file name stems of pipeline results `docs`: their
+    ``_id``, escaped to be a valid file name. Results without scalar
+    ``_id``, or with one already taken, are named by their position as
+    ``~<n>``, which no escaped ``_id`` looks like.
+    """
+
+    names = []
+    taken = set()
+    for position, doc in enumerate(docs):
+        oid = doc.get("_id")
+        name = None
+        if isinstance(oid, basestring):
+            name = urllib.quote(oid.encode("utf-8"), safe="")
+        elif isinstance(oid, (int, long, float, bson.objectid.ObjectId)) \
+                and not isinstance(oid, bool):
+            name = urllib.quote(str(oid), safe="")
+
+        if not name or name in taken or name in (".", "..") or \
+                name + ".json" in Node.CONTROL_FILES:
+            name = "~{}".format(position)
+
+        taken.add(name)
+        names.append(name)
+    return names
+
+
+def dumps(doc):
+
+    return json.dumps(doc,
+                      indent=4,
                       sort_keys=True,
-                      default=bson.json_util.default)
+                      default=json_util.default)
+
+
+def sort_uses_index(indexes, query, sort):
+    """Returns `True` if one of `indexes` (as returned by
+    `index_information()`) can return documents matching `query` in `sort`
+    order.
+
+    Index fields matched by equality in `query` may precede sort fields,
+    and whole index may be walked backwards.
+    """
+
+    equality = set(field for field, value in query.items()
+                   if not isinstance(value, dict) or
+                   not any(key.startswith("$") for key in value))
+
+    for info in indexes.values():
+        keys = list(info["key"])
+        while keys and keys[0][0] in equality and \
+                keys[0][0] not in dict(sort):
+            keys.pop(0)
+
+        prefix = keys[:len(sort)]
+        if any(direction not in (1, -1) for field, direction in prefix):
+            continue
+        if [field for field, direction in prefix] != \
+                [field for field, direction in sort]:
+            continue
+
+        same = [direction == order for (field, direction), (_, order)
+                in zip(prefix, sort)]
+        if all(same) or not any(same):
+            return True
+
+    return False
+
+
+def replica_set_status(conn):
+    """Returns ``replSetGetStatus`` result and replica set configuration
+    of `conn`.
+    """
+
+    status = conn.admin.command("replSetGetStatus")
+    try:
+        config = conn.admin.command("replSetGetConfig")["config"]
+    except pymongo.errors.OperationFailure:
+        # Servers before 3.0 keep it in a collection only
+        config = conn.local["system.replset"].find_one()
+    return status, config
+
+
+def replication_lag(status, config=None):
+    """Returns seconds the most lagging secondary is behind the primary
+    according to ``replSetGetStatus`` `status`, `0` without secondaries,
+    or `None` without primary.
+
+    Members without optime, such as arbiters, are skipped, as well as
+    hidden and delayed members of replica set `config`, which don't serve
+    reads.
+    """
+
+    skipped = set()
+    for member in (config or {}).get("members", []):
+        if member.get("hidden") or member.get("slaveDelay") or \
+                member.get("secondaryDelaySecs"):
+            skipped.add(member.get("_id"))
+
+    optimes = collections.defaultdict(list)
+    for member in status.get("members", []):
+        optime = member.get("optimeDate")
+        if optime is not None and member.get("_id") not in skipped:
+            optimes[member.get("stateStr")].append(optime)
+
+    if not optimes["PRIMARY"]:
+        return None
+    if not optimes["SECONDARY"]:
+        return 0
+
+    lag = optimes["PRIMARY"][0] - min(optimes["SECONDARY"])
+    return max(lag.days * 86400 + lag.seconds, 0)
+
+
+def diff_document(old, new):
+    """Returns ``(to_set, to_unset, conditions)`` describing how to turn
+    `old` document into `new` one with a partial update.
+
+    ``to_set`` and ``to_unset`` map dotted field paths to ``$set`` and
+    ``$unset`` values. ``conditions`` map the same paths to query values
+    matching only documents where they still hold what `old` has.
+    """
+
+    to_set, to_unset, conditions = {}, {}, {}
+    _diff_fields(old, new, "", to_set, to_unset, conditions)
+    return to_set, to_unset, conditions
+
+
+def _diff_fields(old, new, prefix, to_set, to_unset, conditions):
+
+    for key, value in new.items():
+        path = prefix + key
+        if key not in old:
+            to_set[path] = value
+            conditions[path] = {"$exists": False}
+
+        elif query_key(old[key]) == query_key(value):
+            continue
+
+        elif isinstance(old[key], dict) and isinstance(value, dict) and \
+                all(_is_dottable(name) for name in old[key].keys() +
+                                                   value.keys()):
+            _diff_fields(old[key], value, path + ".",
+                         to_set, to_unset, conditions)
+
+        else:
+            to_set[path] = value
+            conditions[path] = _condition(old[key])
+
+    for key in old:
+        if key not in new:
+            path = prefix + key
+            to_unset[path] = ""
+            conditions[path] = _condition(old[key])
+
+
+def _is_dottable(name):
+    """Returns `True` if field `name` can be a part of dotted field path."""
+
+    return "." not in name and not name.startswith("$")
+
+
+def _condition(value):
+    """Returns query value matching field which equals `value`.
+
+    Embedded documents are only required to exist: their key order, which
+    decoding into `dict` loses, would take part in equality match.
+    """
+
+    if isinstance(value, dict) or \
+            isinstance(value, list) and \
+            any(isinstance(item, (dict, list)) for item in value):
+        return {"$exists": True}
+    return value
+
+
+def field_value(doc, field):
+    """Returns value of dotted `field` path in `doc`, looking into first
+    elements of arrays, or `None` if there's no such field.
+    """
+
+    value = doc
+    for name in field.split("."):
+        while isinstance(value, list):
+            value = value[0] if value else None
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    while isinstance(value, list):
+        value = value[0] if value else None
+    return value
+
+
+def is_collscan(plan):
+    """Returns `True` if explained query `plan` scans whole collection."""
+
+    # Servers before 3.0
+    if plan.get("cursor") == "BasicCursor":
+        return True
+
+    stages = [plan.get("queryPlanner", {}).get("winningPlan", {})]
+    while stages:
+        stage = stages.pop()
+        if stage.get("stage") == "COLLSCAN":
+            return True
+        stages.extend(stage.get("inputStages", []))
+        if "inputStage" in stage:
+            stages.append(stage["inputStage"])
+    return False
+
+
+def pipeline_key(db, coll, pipeline):
+    """Returns hash identifying results of `pipeline` run on `db.coll`."""
+
+    content = query_key([db, coll, pipeline])
+    return hashlib.sha1(content).hexdigest()
+
+
+def query_key(query):
+    """Returns hashable canonical form of `query`."""
+
+    return json.dumps(query, sort_keys=True, default=json_util.default)
+
+
+def render(doc, ext):
+    """Returns content of document file with extension `ext`."""
+
+    if ext == ".bson":
+        return bson.BSON.encode(doc)
+    return dumps(doc)
 
 
 def loads(string):
     """Returns document parsed from `string`. """
 
-    return json.loads(string, object_hook=bson.json_util.object_hook)
+    return json.loads(string, object_hook=json_util.object_hook)
 
 
 def main():
@@ -443,11 +2681,182 @@ def main():
                         help="MongoDB connection string. Default is %(default)s",
                         default="localhost:27017",
                         metavar="HOST:PORT")
+    parser.add_argument("--connect-timeout",
+                        help="Seconds to wait for MongoDB server. "
+                             "Default is %(default)s",
+                        type=float,
+                        default=5,
+                        metavar="SECS")
+    parser.add_argument("--replica-set",
+                        help="Replica set name, enables routing reads "
+                             "to secondaries",
+                        metavar="NAME")
+    parser.add_argument("--read-preference",
+                        help="Where to read documents and listings from "
+                             "when --replica-set is given. Writes always "
+                             "go to primary. Default is %(default)s",
+                        choices=READ_PREFERENCES.keys(),
+                        default="secondaryPreferred")
+    parser.add_argument("--max-staleness",
+                        help="Read from primary while any secondary lags "
+                             "more than given seconds behind it",
+                        type=float,
+                        metavar="SECS")
+    parser.add_argument("--pipeline-ttl",
+                        help="Seconds to reuse results of pipeline.json "
+                             "aggregations. Default is %(default)s",
+                        type=float,
+                        default=60,
+                        metavar="SECS")
+    parser.add_argument("--materialize-pipelines",
+                        help="Keep pipeline results in scratch collections "
+                             "shared by all mounts",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--bson",
+                        help="Show documents as raw BSON .bson files "
+                             "next to .json ones",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--namespace-ttl",
+                        help="Seconds to reuse database and collection "
+                             "names and sizes. Default is %(default)s",
+                        type=float,
+                        default=10,
+                        metavar="SECS")
+    parser.add_argument("--collscan-limit",
+                        help="Check listings of collections with more "
+                             "documents for full collection scans",
+                        type=int,
+                        metavar="DOCS")
+    parser.add_argument("--collscan-action",
+                        help="What to do with listings scanning whole "
+                             "collection. Default is %(default)s",
+                        choices=["warn", "refuse"],
+                        default="warn")
+    parser.add_argument("--readahead",
+                        help="Most documents to fetch ahead while a folder "
+                             "is read in listing order, 0 to disable. "
+                             "Default is %(default)s",
+                        type=int,
+                        default=32,
+                        metavar="DOCS")
+    parser.add_argument("--pinned-docs",
+                        help="Number of frequently read documents kept "
+                             "cached apart from others. "
+                             "Default is %(default)s",
+                        type=int,
+                        default=256,
+                        metavar="DOCS")
+    parser.add_argument("--cache-size",
+                        help="Memory for cached document contents, in "
+                             "megabytes. Default is %(default)s",
+                        type=float,
+                        default=64,
+                        metavar="MB")
+    parser.add_argument("--compress",
+                        help="Codec compressing cached document contents. "
+                             "Default is %(default)s",
+                        choices=CODECS.keys(),
+                        default="zlib")
+    parser.add_argument("--compress-min",
+                        help="Compress cached contents of this size or "
+                             "larger. Default is %(default)s",
+                        type=int,
+                        default=1024,
+                        metavar="BYTES")
+    parser.add_argument("--shared-cache",
+                        help="File caching document contents for all "
+                             "mounts of the host using it",
+                        metavar="PATH")
+    parser.add_argument("--shared-cache-size",
+                        help="Size of --shared-cache file, in megabytes. "
+                             "Default is %(default)s",
+                        type=float,
+                        default=64,
+                        metavar="MB")
+    parser.add_argument("--shared-cache-ttl",
+                        help="Seconds to reuse contents of --shared-cache "
+                             "entries. Default is %(default)s",
+                        type=float,
+                        default=MongoFuse.BODY_TTL,
+                        metavar="SECS")
+    parser.add_argument("--entry-timeout",
+                        help="Seconds kernel caches name lookups. "
+                             "Default is %(default)s",
+                        type=float,
+                        default=1,
+                        metavar="SECS")
+    parser.add_argument("--attr-timeout",
+                        help="Seconds kernel caches file attributes. "
+                             "Default is %(default)s",
+                        type=float,
+                        default=1,
+                        metavar="SECS")
+    parser.add_argument("--negative-timeout",
+                        help="Seconds kernel caches failed lookups. "
+                             "Default is %(default)s",
+                        type=float,
+                        default=0,
+                        metavar="SECS")
+    cache = parser.add_mutually_exclusive_group()
+    cache.add_argument("--kernel-cache",
+                       help="Always keep file contents in page cache. "
+                            "Documents changed outside the mount may "
+                            "be read stale",
+                       action="store_true",
+                       default=False)
+    cache.add_argument("--auto-cache",
+                       help="Let FUSE drop cached file contents when size "
+                            "or modification time changes, instead of "
+                            "comparing document content on open",
+                       action="store_true",
+                       default=False)
+    parser.add_argument("--max-read",
+                        help="Maximum size of read requests, in bytes",
+                        type=int,
+                        metavar="BYTES")
     args = parser.parse_args()
 
-    fuse = FUSE(MongoFuse(args.db),
-                args.mount_point,
-                foreground=args.foreground)
+    # Values are passed as strings: fusepy turns `True`-like values
+    # (including 1 and 1.0) into bare flags
+    options = dict(entry_timeout=str(args.entry_timeout),
+                   attr_timeout=str(args.attr_timeout),
+                   negative_timeout=str(args.negative_timeout))
+    if args.kernel_cache:
+        options['kernel_cache'] = True
+    if args.auto_cache:
+        options['auto_cache'] = True
+    if args.max_read:
+        options['max_read'] = str(args.max_read)
+
+    read_preference = args.read_preference if args.replica_set else None
+    filesystem = MongoFuse(args.db,
+                           connect_timeout=args.connect_timeout,
+                           replica_set=args.replica_set,
+                           read_preference=read_preference,
+                           max_staleness=args.max_staleness,
+                           pipeline_ttl=args.pipeline_ttl,
+                           materialize_pipelines=args.materialize_pipelines,
+                           bson_files=args.bson,
+                           namespace_ttl=args.namespace_ttl,
+                           collscan_limit=args.collscan_limit,
+                           collscan_action=args.collscan_action,
+                           readahead=args.readahead,
+                           pinned_docs=args.pinned_docs,
+                           cache_bytes=int(args.cache_size * (1 << 20)),
+                           codec=args.compress,
+                           compress_min=args.compress_min,
+                           shared_cache=args.shared_cache,
+                           shared_cache_bytes=int(args.shared_cache_size *
+                                                  (1 << 20)),
+                           shared_ttl=args.shared_cache_ttl)
+
+    fuse.FUSE(filesystem,
+              args.mount_point,
+              raw_fi=True,
+              foreground=args.foreground,
+              **options)
 
 if __name__ == '__main__':
     main()
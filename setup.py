@@ -18,6 +18,7 @@ setup(
     entry_points = {
         'console_scripts': [
             'mongofuse = mongofuse.mongofuse:main',
+            'mongofuse-loadtest = mongofuse.loadtest:main',
         ]
     }
 )
@@ -1,14 +1,20 @@
 # Standard modules:
 import unittest
 import stat
+import errno
 import textwrap
 import datetime
 import time
+import threading
+import json
+import os
+import tempfile
 
 # Third-party modules:
 import pymongo
 import bson
 import mongofuse
+import mongofuse.loadtest
 import fuse
 
 TEST_DB = "localhost:27017"
@@ -148,6 +154,50 @@ class RepresentCollectionsAsSubfoldersTest(FuseTest):
         self.assertTrue(stat.S_ISDIR(attrs['st_mode']))
 
 
+class DirectoryMetadataTest(FuseTest):
+
+    def test_should_report_collection_count_and_size(self):
+
+        # Given MongoDB collection with documents
+        coll = self.conn.test_db.test_coll
+        for n in range(5):
+            coll.save({"n": n})
+
+        # When getting attributes for the collection folder
+        attrs = self.fuse.getattr("/test_db/test_coll")
+
+        # Then link count and size should come from collection stats
+        stats = self.conn.test_db.command("collstats", "test_coll")
+        self.assertEqual(attrs['st_nlink'], 2 + 5)
+        self.assertEqual(attrs['st_size'], int(stats['size']))
+
+    def test_should_report_database_collection_count(self):
+
+        # Given MongoDB database with collections
+        self.conn.test_db.coll_1.save({"n": 1})
+        self.conn.test_db.coll_2.save({"n": 2})
+
+        # When getting attributes for the database folder
+        attrs = self.fuse.getattr("/test_db")
+
+        # Then link count should include collections
+        stats = self.conn.test_db.command("dbstats")
+        self.assertEqual(attrs['st_nlink'], 2 + stats['collections'])
+
+    def test_should_reuse_stats_within_namespace_ttl(self):
+
+        # Given collection attributes fetched once
+        self.conn.test_db.test_coll.save({"n": 1})
+        self.fuse.getattr("/test_db/test_coll")
+        round_trips = self.fuse.backend.round_trips
+
+        # When getting them again
+        self.fuse.getattr("/test_db/test_coll")
+
+        # Then server shouldn't be asked again
+        self.assertEqual(self.fuse.backend.round_trips, round_trips)
+
+
 class ShowFirstDocumentsAsJsonFilesTest(FuseTest):
 
     def test_readdir(self):
@@ -273,6 +323,164 @@ class ShowFirstDocumentsAsJsonFilesTest(FuseTest):
         self.assertEqual(doc['age'], 25)
 
 
+class RawBsonFilesTest(FuseTest):
+
+    def setUp(self):
+        super(RawBsonFilesTest, self).setUp()
+        self.fuse = mongofuse.MongoFuse(conn_string=TEST_DB, bson_files=True)
+        self.fuse.attrs_cache = mongofuse.LRUCache(expire_secs=0)
+
+    def test_should_list_and_read_bson_files(self):
+
+        # Given MongoDB document
+        coll = self.conn.test_db.test_coll
+        oid = coll.save({"name": "Aleksey", "age": 27})
+
+        # When listing collection folder
+        readdir = self.fuse.readdir("/test_db/test_coll")
+
+        # Then document should be listed both as JSON and BSON file
+        self.assertIn("{}.json".format(oid), readdir)
+        self.assertIn("{}.bson".format(oid), readdir)
+
+        # And BSON file should contain encoded document
+        filename = "/test_db/test_coll/{}.bson".format(oid)
+        content = self.fuse.read(filename, 1000)
+        self.assertEqual(bson.BSON(content).decode(), coll.find_one(oid))
+        self.assertEqual(self.fuse.getattr(filename)['st_size'],
+                         len(content))
+
+    def test_should_save_written_bson_files(self):
+
+        # When writing BSON to a file with objectid-like name
+        oid = bson.objectid.ObjectId()
+        filename = "/test_db/test_coll/{}.bson".format(oid)
+        self.fuse.create(filename, 0644)
+        self.fuse.write(filename, bson.BSON.encode({"foo": "bar"}))
+
+        # Then MongoDB document with this id should be created
+        doc = self.conn.test_db.test_coll.find_one(oid)
+        self.assertEqual(doc['foo'], 'bar')
+
+    def test_should_reject_malformed_bson(self):
+
+        filename = "/test_db/test_coll/{}.bson".format(bson.objectid.ObjectId())
+        with self.assertRaises(fuse.FuseOSError):
+            self.fuse.write(filename, "not bson")
+
+
+class BufferedWritesTest(FuseTest):
+
+    def test_should_save_document_written_in_chunks_on_flush(self):
+
+        # Given created .bson file
+        oid = bson.ObjectId()
+        filename = "/test_db/test_coll/{}.bson".format(oid)
+        fi = FileInfo(os.O_WRONLY)
+        self.fuse.create(filename, 0660, fi)
+
+        # When document larger than one write is written in chunks
+        data = bson.BSON.encode({"_id": oid, "big": "x" * 10000})
+        for offset in range(0, len(data), 4096):
+            self.fuse.write(filename, data[offset:offset + 4096], offset, fi)
+
+        # Then it should be saved on flush
+        self.assertIsNone(self.conn.test_db.test_coll.find_one(oid))
+        self.fuse.flush(filename, fi)
+        self.fuse.release(filename, fi)
+        self.assertEqual(self.conn.test_db.test_coll.find_one(oid)["big"],
+                         "x" * 10000)
+
+    def test_should_truncate_and_rewrite_opened_document(self):
+
+        # Given document opened for writing
+        coll = self.conn.test_db.test_coll
+        oid = coll.save({"foo": "bar"})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        fi = FileInfo(os.O_RDWR)
+        self.fuse.open(filename, fi)
+
+        # When truncating it, and writing new content
+        self.fuse.truncate(filename, 0, fi)
+        head = '{"_id": {"$oid": "%s"}, ' % oid
+        self.fuse.write(filename, head, 0, fi)
+        self.fuse.write(filename, '"foo": "baz"}', len(head), fi)
+        self.fuse.release(filename, fi)
+
+        # Then new content should be saved on release
+        self.assertEqual(coll.find_one(oid)["foo"], "baz")
+
+    def test_should_read_written_content_before_it_is_saved(self):
+
+        # Given document read through file opened for writing
+        oid = self.conn.test_db.test_coll.save({"foo": "bar"})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        fi = FileInfo(os.O_RDWR)
+        self.fuse.open(filename, fi)
+        self.fuse.read(filename, 4096, 0, fi)
+
+        # When it's truncated and written
+        self.fuse.truncate(filename, 0, fi)
+        self.fuse.write(filename, '{"foo": "NEW"}', 0, fi)
+
+        # Then reads of the file should return what's written
+        self.assertEqual(self.fuse.read(filename, 4096, 0, fi),
+                         '{"foo": "NEW"}')
+        self.assertEqual(self.fuse.read(filename, 3, 9, fi), 'NEW')
+
+    def test_should_drop_attributes_of_every_extension_on_save(self):
+
+        # Given document shown as .json and .bson files, with cached sizes
+        self.fuse.extensions = mongofuse.DOCUMENT_EXTENSIONS
+        oid = self.conn.test_db.test_coll.save({"foo": "bar"})
+        stem = "/test_db/test_coll/{}".format(oid)
+        for ext in mongofuse.DOCUMENT_EXTENSIONS:
+            self.fuse.attrs_cache[stem + ext] = self.fuse.getattr(stem + ext)
+
+        # When it's saved through one of them
+        fi = FileInfo(os.O_WRONLY | os.O_TRUNC)
+        self.fuse.open(stem + ".json", fi)
+        self.fuse.write(stem + ".json", '{"foo": "longer"}', 0, fi)
+        self.fuse.release(stem + ".json", fi)
+
+        # Then cached attributes of both should be dropped
+        for ext in mongofuse.DOCUMENT_EXTENSIONS:
+            self.assertNotIn(stem + ext, self.fuse.attrs_cache)
+
+    def test_should_refuse_malformed_content_on_flush(self):
+        oid = self.conn.test_db.test_coll.save({"foo": "bar"})
+        filename = "/test_db/test_coll/{}.bson".format(oid)
+        fi = FileInfo(os.O_WRONLY | os.O_TRUNC)
+        self.fuse.open(filename, fi)
+        self.fuse.write(filename, "not bson", 0, fi)
+        with self.assertRaises(fuse.FuseOSError):
+            self.fuse.flush(filename, fi)
+
+    def test_should_open_created_bson_file_before_it_is_written(self):
+        filename = "/test_db/test_coll/{}.bson".format(bson.ObjectId())
+        self.fuse.create(filename, 0660, FileInfo())
+        self.fuse.open(filename, FileInfo())
+
+    def test_should_give_distinct_handles_to_concurrent_opens(self):
+
+        # Given document file
+        oid = self.conn.test_db.test_coll.save({"foo": "bar"})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+
+        # When it's opened from many threads at once
+        files = [FileInfo() for n in range(200)]
+        threads = [threading.Thread(target=self.fuse.open,
+                                    args=(filename, fi))
+                   for fi in files]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Then every open file should get its own handle
+        self.assertEqual(len(set(fi.fh for fi in files)), len(files))
+
+
 class FilterCollectionsWithSavedQueries(FuseTest):
 
     def test_should_return_only_matching_documents_when_query_file_present(self):
@@ -331,6 +539,298 @@ class FilterCollectionsWithSavedQueries(FuseTest):
         self.assertEqual(query, {"foo": "bar"})
 
 
+class TypedQueryPlaceholdersTest(FuseTest):
+
+    def setUp(self):
+        super(TypedQueryPlaceholdersTest, self).setUp()
+
+        # Given mongodb documents
+        self.coll = self.conn.test_db.test_coll
+        self.coll.save({"code": "42", "age": 42, "ref": bson.ObjectId(),
+                        "born": datetime.datetime(2000, 1, 2, 10)})
+
+    def query(self, template, folder):
+        self.fuse.write("/test_db/test_coll/query.json", template)
+        return self.fuse._get_query("/test_db/test_coll/" + folder)
+
+    def test_should_keep_numeric_folder_name_string_for_string_field(self):
+        self.assertEqual(self.query('{"code": $1}', "42"), {"code": "42"})
+
+    def test_should_convert_folder_name_to_int_for_int_field(self):
+        self.assertEqual(self.query('{"age": "$1"}', "42"), {"age": 42})
+        self.assertEqual(self.query('{"age": {"$gte": $1}}', "7"),
+                         {"age": {"$gte": 7}})
+
+    def test_should_convert_folder_name_to_object_id_for_oid_field(self):
+        oid = bson.ObjectId()
+        self.assertEqual(self.query('{"ref": $1}', str(oid)), {"ref": oid})
+
+    def test_should_match_whole_day_for_date_folder_name(self):
+        self.assertEqual(self.query('{"born": $1}', "2000-01-02"),
+                         {"born": {"$gte": datetime.datetime(2000, 1, 2),
+                                   "$lt": datetime.datetime(2000, 1, 3)}})
+
+    def test_should_substitute_placeholder_in_part_of_string(self):
+        self.assertEqual(self.query('{"code": "item-$1"}', "7"),
+                         {"code": "item-7"})
+
+    def test_should_treat_inconvertible_folder_name_as_malformed_query(self):
+        self.assertIsNone(self.query('{"age": $1}', "old"))
+
+    def test_should_guess_type_for_unknown_field(self):
+        self.assertEqual(self.query('{"x": $1}', "7"), {"x": 7})
+        self.assertEqual(self.query('{"x": $1}', "abc"), {"x": "abc"})
+        self.assertEqual(self.query('{"x": "$1"}', "7"), {"x": "7"})
+
+    def test_should_infer_type_once_collection_has_field(self):
+
+        # Given query on field no document has yet
+        self.assertEqual(self.query('{"name": $1}', "42"), {"name": 42})
+
+        # When document with string field is saved
+        self.coll.save({"name": "alice"})
+
+        # Then folder name should bind as string
+        self.assertEqual(self.query('{"name": $1}', "42"), {"name": "42"})
+
+    def test_should_not_scan_large_collection_to_infer_type(self):
+
+        # Given guard refusing scans of collections over 1 document
+        self.fuse.collscan_limit = 1
+        self.fuse.collscan_action = "refuse"
+        self.coll.save({"code": "43"})
+        round_trips = self.fuse.backend.round_trips
+
+        # When query on unindexed field is used
+        query = self.query('{"code": $1}', "42")
+
+        # Then type should be guessed, checking only collection size and
+        # indexes instead of looking for a document
+        self.assertEqual(query, {"code": 42})
+        self.assertEqual(self.fuse.backend.round_trips - round_trips, 2)
+
+
+class SortAndLimitViewsTest(FuseTest):
+
+    def test_should_list_documents_in_sort_file_order(self):
+
+        # Given mongodb documents
+        coll = self.conn.test_db.test_coll
+        oids = [coll.save({"n": n}) for n in (2, 3, 1)]
+
+        # When saving sort and limit files in collection folder
+        self.fuse.write("/test_db/test_coll/sort.json", '{"n": -1}')
+        self.fuse.write("/test_db/test_coll/limit", '2')
+
+        # Then only top documents should be listed in sort order
+        docs = self.fuse._list_documents("/test_db/test_coll")
+        self.assertEqual(docs, ["{}.json".format(oids[1]),
+                                "{}.json".format(oids[0])])
+
+        # And control files should be listed as well
+        readdir = self.fuse.readdir("/test_db/test_coll")
+        self.assertIn("sort.json", readdir)
+        self.assertIn("limit", readdir)
+
+    def test_should_generate_sort_and_limit_from_top_folder_names(self):
+
+        # Given MongoDB database and collection
+        self.conn.test_db.create_collection('test_coll')
+
+        # When creating subfolder with a special name "top_<n>_by_<field>"
+        self.fuse.mkdir("/test_db/test_coll/top_1000_by_created", 0777)
+
+        # Then sort and limit files should be generated in this folder
+        path = "/test_db/test_coll/top_1000_by_created"
+        self.assertEqual(self.fuse.read(path + "/sort.json", 100),
+                         '{"created": -1}')
+        self.assertEqual(self.fuse.read(path + "/limit", 100), '1000')
+
+    def test_should_list_nothing_for_malformed_sort(self):
+
+        # Given mongodb document
+        self.conn.test_db.test_coll.save({"n": 1})
+
+        # When saving malformed sort file
+        self.fuse.write("/test_db/test_coll/sort.json", '{"n": "up"}')
+
+        # Then no docs should be listed
+        self.assertEqual(self.fuse._list_documents("/test_db/test_coll"), [])
+
+    def test_should_list_nothing_for_zero_limit(self):
+
+        # Given mongodb document
+        self.conn.test_db.test_coll.save({"n": 1})
+
+        # When saving zero limit, which means no limit to MongoDB
+        self.fuse.write("/test_db/test_coll/limit", '0')
+
+        # Then no docs should be listed
+        self.assertEqual(self.fuse._list_documents("/test_db/test_coll"), [])
+
+
+class AggregationPipelineViewsTest(FuseTest):
+
+    pipeline = '''[{"$group": {"_id": "$city", "total": {"$sum": 1}}},
+                   {"$sort": {"_id": 1}}]'''
+
+    def setUp(self):
+        super(AggregationPipelineViewsTest, self).setUp()
+
+        # Given mongodb documents
+        coll = self.conn.test_db.test_coll
+        for city in ("Moscow", "Kiev", "Moscow"):
+            coll.save({"city": city})
+
+        # And pipeline.json in a view folder
+        self.fuse.mkdir("/test_db/test_coll/cities", 0777)
+        self.fuse.write("/test_db/test_coll/cities/pipeline.json",
+                        self.pipeline)
+
+    def test_should_list_pipeline_results_as_files(self):
+
+        # When listing files in view folder
+        readdir = self.fuse.readdir("/test_db/test_coll/cities")
+
+        # Then pipeline results should be listed
+        self.assertIn("Kiev.json", readdir)
+        self.assertIn("Moscow.json", readdir)
+        self.assertIn("pipeline.json", readdir)
+
+        # And their content should be returned by read
+        content = self.fuse.read("/test_db/test_coll/cities/Moscow.json",
+                                 1000)
+        self.assertEqual(mongofuse.loads(content),
+                         {"_id": "Moscow", "total": 2})
+
+    def test_should_reuse_pipeline_results(self):
+
+        # Given listed pipeline results
+        self.fuse.readdir("/test_db/test_coll/cities")
+        round_trips = self.fuse.backend.round_trips
+
+        # When reading them again
+        self.fuse.readdir("/test_db/test_coll/cities")
+        self.fuse.read("/test_db/test_coll/cities/Kiev.json", 1000)
+
+        # Then pipeline shouldn't be run again
+        self.assertEqual(self.fuse.backend.round_trips, round_trips)
+
+    def test_should_name_results_without_unique_id_by_position(self):
+
+        # Given pipeline results without _id, or sharing one
+        self.fuse.backend.aggregate = lambda *args, **kwargs: [
+            {"city": "Moscow"}, {"city": "Kiev"}, {"_id": 1}, {"_id": 1}]
+
+        # When listing files in view folder
+        readdir = self.fuse.readdir("/test_db/test_coll/cities")
+
+        # Then they should be named by position
+        self.assertEqual(readdir[2:6],
+                         ["~0.json", "~1.json", "1.json", "~3.json"])
+        content = self.fuse.read("/test_db/test_coll/cities/~1.json", 1000)
+        self.assertEqual(mongofuse.loads(content), {"city": "Kiev"})
+
+    def test_should_escape_result_ids_into_file_names(self):
+        docs = [{"_id": "a/b"}, {"_id": 7}, {"_id": {"x": 1}},
+                {"_id": "a/b"}, {"_id": "query"}, {"_id": "~0"}]
+        self.assertEqual(mongofuse.result_names(docs),
+                         ["a%2Fb", "7", "~2", "~3", "~4", "%7E0"])
+
+    def test_should_not_write_pipeline_results(self):
+
+        with self.assertRaises(fuse.FuseOSError):
+            self.fuse.write("/test_db/test_coll/cities/Kiev.json",
+                            '{"_id": "Kiev", "total": 10}')
+
+
+class ExplainViewsTest(FuseTest):
+
+    def setUp(self):
+        super(ExplainViewsTest, self).setUp()
+
+        # Given mongodb documents
+        coll = self.conn.test_db.test_coll
+        for n in range(3):
+            coll.save({"n": n})
+
+    def test_should_explain_folder_query_and_last_listing(self):
+
+        # Given listed collection folder
+        readdir = self.fuse.readdir("/test_db/test_coll")
+
+        # When reading explain.json
+        self.assertIn("explain.json", readdir)
+        content = self.fuse.read("/test_db/test_coll/explain.json", 100000)
+
+        # Then it should include server's explanation and listing timing
+        report = mongofuse.loads(content)
+        self.assertEqual(report["query"], {})
+        self.assertIn("executionStats", report["explain"])
+        self.assertEqual(report["lastListing"]["documents"], 3)
+
+    def test_should_not_run_query_to_stat_explain_file(self):
+
+        # When listing folder with sizes, as ls -l does
+        self.fuse.readdir("/test_db/test_coll")
+        round_trips = self.fuse.backend.round_trips
+        attrs = self.fuse.getattr("/test_db/test_coll/explain.json")
+
+        # Then query shouldn't be explained
+        self.assertEqual(self.fuse.backend.round_trips, round_trips)
+        self.assertEqual(attrs['st_size'], 0)
+
+        # And file should be read bypassing page cache
+        fi = FileInfo()
+        self.fuse.open("/test_db/test_coll/explain.json", fi)
+        self.assertTrue(fi.direct_io)
+
+    def test_should_refuse_collection_scans_over_size_limit(self):
+
+        # Given guard refusing scans of collections over 2 documents
+        self.fuse.collscan_limit = 2
+        self.fuse.collscan_action = "refuse"
+
+        # When listing collection folder without index on query
+        docs = self.fuse._list_documents("/test_db/test_coll")
+
+        # Then no documents should be listed
+        self.assertEqual(docs, [])
+
+        # And explain.json should tell why
+        content = self.fuse.read("/test_db/test_coll/explain.json", 100000)
+        self.assertIn("refused", mongofuse.loads(content))
+
+    def test_should_not_write_explain_file(self):
+
+        with self.assertRaises(fuse.FuseOSError):
+            self.fuse.write("/test_db/test_coll/explain.json", "{}")
+
+
+class SortUsesIndexTest(unittest.TestCase):
+
+    indexes = {"_id_": {"key": [("_id", 1)]},
+               "user_1_created_-1": {"key": [("user", 1), ("created", -1)]}}
+
+    def test_should_accept_index_prefix_in_either_direction(self):
+        self.assertTrue(mongofuse.sort_uses_index(
+            self.indexes, {}, [("_id", -1)]))
+        self.assertTrue(mongofuse.sort_uses_index(
+            self.indexes, {}, [("user", -1), ("created", 1)]))
+
+    def test_should_skip_fields_matched_by_equality(self):
+        self.assertTrue(mongofuse.sort_uses_index(
+            self.indexes, {"user": "bob"}, [("created", -1)]))
+
+    def test_should_reject_unindexed_sort(self):
+        self.assertFalse(mongofuse.sort_uses_index(
+            self.indexes, {}, [("created", -1)]))
+        self.assertFalse(mongofuse.sort_uses_index(
+            self.indexes, {"user": {"$gt": "a"}}, [("created", -1)]))
+        self.assertFalse(mongofuse.sort_uses_index(
+            self.indexes, {}, [("user", 1), ("created", 1)]))
+
+
 class CreateDocumentTest(FuseTest):
 
     def test_should_create_new_doc_when_writing_special_file(self):
@@ -383,6 +883,122 @@ class EditExistingDocsTest(FuseTest):
         self.assertEqual(doc['new'], 'key')
 
 
+class PartialUpdateTest(FuseTest):
+
+    def test_should_update_only_changed_fields_of_opened_document(self):
+
+        # Given opened document file
+        coll = self.conn.test_db.test_coll
+        oid = coll.save({"foo": "bar", "big": "x" * 1000, "old": 1})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        fi = FileInfo(os.O_RDWR | os.O_TRUNC)
+        self.fuse.open(filename, fi)
+
+        # And field changed outside the mount, which user doesn't edit
+        coll.update({"_id": oid}, {"$set": {"other": "value"}})
+
+        # When writing document with one field changed and one removed
+        doc = coll.find_one(oid)
+        doc.pop("other")
+        doc.pop("old")
+        doc["foo"] = "baz"
+        self.fuse.write(filename, mongofuse.dumps(doc), 0, fi)
+        self.fuse.flush(filename, fi)
+
+        # Then only these fields should be updated
+        doc = coll.find_one(oid)
+        self.assertEqual(doc["foo"], "baz")
+        self.assertNotIn("old", doc)
+        self.assertEqual(doc["other"], "value")
+
+    def test_should_refuse_to_overwrite_concurrent_changes(self):
+
+        # Given opened document file
+        coll = self.conn.test_db.test_coll
+        oid = coll.save({"foo": "bar"})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        fi = FileInfo(os.O_WRONLY | os.O_TRUNC)
+        self.fuse.open(filename, fi)
+
+        # And the same field changed outside the mount
+        coll.update({"_id": oid}, {"$set": {"foo": "concurrent"}})
+
+        # When writing document with this field changed
+        content = mongofuse.dumps({"_id": oid, "foo": "mine"})
+
+        # Then error should be raised and other change kept
+        self.fuse.write(filename, content, 0, fi)
+        with self.assertRaises(fuse.FuseOSError):
+            self.fuse.flush(filename, fi)
+        self.assertEqual(coll.find_one(oid)["foo"], "concurrent")
+
+    def test_should_diff_against_document_as_own_file_opened_it(self):
+
+        # Given document opened for writing
+        coll = self.conn.test_db.test_coll
+        oid = coll.save({"foo": "bar", "n": 1})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        first = FileInfo(os.O_RDWR | os.O_TRUNC)
+        self.fuse.open(filename, first)
+
+        # And changed outside the mount, then opened again
+        coll.update({"_id": oid}, {"$set": {"foo": "external"}})
+        self.fuse.open(filename, FileInfo(os.O_RDWR))
+
+        # When first file saves another field, with foo as it saw it
+        content = mongofuse.dumps({"_id": oid, "foo": "bar", "n": 2})
+        self.fuse.write(filename, content, 0, first)
+        self.fuse.flush(filename, first)
+
+        # Then external change should be kept
+        doc = coll.find_one(oid)
+        self.assertEqual(doc["foo"], "external")
+        self.assertEqual(doc["n"], 2)
+
+    def test_should_snapshot_only_files_opened_for_writing(self):
+
+        # Given MongoDB document
+        oid = self.conn.test_db.test_coll.save({"foo": "bar"})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+
+        # When opening it for reading
+        self.fuse.open(filename, FileInfo())
+
+        # Then no snapshot should be kept
+        self.assertEqual(len(self.fuse._snapshots), 0)
+
+        # When opening it for writing, and releasing
+        fi = FileInfo(os.O_RDWR)
+        self.fuse.open(filename, fi)
+        self.assertEqual(len(self.fuse._snapshots), 1)
+        self.fuse.release(filename, fi)
+
+        # Then snapshot should be dropped
+        self.assertEqual(len(self.fuse._snapshots), 0)
+
+
+class DiffDocumentTest(unittest.TestCase):
+
+    def test_should_diff_embedded_documents_by_dotted_paths(self):
+
+        old = {"_id": 1, "a": {"b": 1, "c": 2}, "d": [1, 2], "e": True}
+        new = {"_id": 1, "a": {"b": 1, "c": 3}, "d": [1, 2], "f": 1}
+
+        to_set, to_unset, conditions = mongofuse.diff_document(old, new)
+
+        self.assertEqual(to_set, {"a.c": 3, "f": 1})
+        self.assertEqual(to_unset, {"e": ""})
+        self.assertEqual(conditions, {"a.c": 2,
+                                      "e": True,
+                                      "f": {"$exists": False}})
+
+    def test_should_detect_type_changes(self):
+
+        to_set, to_unset, conditions = mongofuse.diff_document(
+            {"a": 1}, {"a": True})
+        self.assertEqual(to_set, {"a": True})
+
+
 class DeleteDocumentTest(FuseTest):
 
     def test_should_delete_mongo_doc_on_unlink_file_operation(self):
@@ -447,6 +1063,536 @@ class CreateCustomCollectionViews(FuseTest):
         self.assertEqual(query, '{"testId": $1}')
 
 
+class FileInfo(object):
+    """Stand-in for fuse_file_info passed to `open()` in raw_fi mode."""
+
+    fh = 0
+    direct_io = False
+    keep_cache = False
+
+    def __init__(self, flags=os.O_RDONLY):
+        self.flags = flags
+
+
+class KernelPageCacheTest(FuseTest):
+
+    def test_should_keep_cache_while_document_unchanged(self):
+
+        # Given MongoDB document
+        coll = self.conn.test_db.test_coll
+        oid = coll.save({"foo": "bar"})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+
+        # When opening its file twice
+        first, second = FileInfo(), FileInfo()
+        self.fuse.open(filename, first)
+        self.fuse.open(filename, second)
+
+        # Then cached pages should be kept only on second open
+        self.assertFalse(first.keep_cache)
+        self.assertTrue(second.keep_cache)
+
+    def test_should_drop_cache_after_document_changed(self):
+
+        # Given opened document file
+        coll = self.conn.test_db.test_coll
+        oid = coll.save({"foo": "bar"})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        self.fuse.open(filename, FileInfo())
+
+        # When document is changed outside the mount, and cached content
+        # expires
+        coll.save({"_id": oid, "foo": "baz"})
+        self.fuse.bodies.ttl = 0
+
+        # Then cached pages should be dropped on next open
+        fi = FileInfo()
+        self.fuse.open(filename, fi)
+        self.assertFalse(fi.keep_cache)
+
+    def test_should_bypass_cache_for_query_files(self):
+
+        # When opening query.json
+        fi = FileInfo()
+        self.fuse.open("/test_db/test_coll/query.json", fi)
+
+        # Then its content should never be cached by kernel
+        self.assertTrue(fi.direct_io)
+
+
+class ReadAheadAndPinningTest(FuseTest):
+
+    def test_should_prefetch_documents_read_in_listing_order(self):
+
+        # Given listed collection folder
+        coll = self.conn.test_db.test_coll
+        for n in range(10):
+            coll.save({"n": n})
+        names = self.fuse._list_documents("/test_db/test_coll")
+
+        # And bodies cached by listing expired
+        self.fuse.bodies = mongofuse.BodyCache(ttl=60)
+        round_trips = self.fuse.backend.round_trips
+
+        # When reading documents in listing order, as cat does
+        for name in names[:8]:
+            path = "/test_db/test_coll/" + name
+            fi = FileInfo()
+            self.fuse.open(path, fi)
+            self.fuse.read(path, 4096, 0, fi)
+            self.fuse.release(path, fi)
+            time.sleep(0.1)
+
+        # Then following documents should have been fetched ahead
+        stats = self.fuse.bodies.stats()
+        self.assertGreater(stats["readahead_hits"], 4)
+
+        # And be read without more round trips
+        self.assertLess(self.fuse.backend.round_trips - round_trips, 6)
+
+    def test_should_not_prefetch_documents_cached_by_listing(self):
+
+        # Given listed collection folder
+        coll = self.conn.test_db.test_coll
+        for n in range(10):
+            coll.save({"n": n})
+        names = self.fuse._list_documents("/test_db/test_coll")
+        round_trips = self.fuse.backend.round_trips
+
+        # When reading documents in listing order
+        for name in names[:8]:
+            path = "/test_db/test_coll/" + name
+            fi = FileInfo()
+            self.fuse.open(path, fi)
+            self.fuse.read(path, 4096, 0, fi)
+            self.fuse.release(path, fi)
+        time.sleep(0.1)
+
+        # Then they should be read from cache, with nothing to fetch
+        self.assertEqual(self.fuse.backend.round_trips, round_trips)
+        self.assertEqual(self.fuse.bodies.stats()["readahead"], 0)
+
+    def test_should_report_cache_hits_in_stats_file(self):
+
+        # Given document file read twice
+        oid = self.conn.test_db.test_coll.save({"foo": "bar"})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        self.fuse.read(filename, 4096)
+        self.fuse.read(filename, 4096)
+
+        # Then stats.json should be listed at root, and report cache hits
+        self.assertIn("stats.json", self.fuse.readdir("/"))
+        stats = json.loads(self.fuse.read("/stats.json", 4096))
+        self.assertEqual(stats["bodies"]["hits"], 1)
+        self.assertEqual(stats["bodies"]["misses"], 1)
+        self.assertEqual(stats["bodies"]["hit_rate"], 0.5)
+
+
+class CompressedDocumentFilesTest(FuseTest):
+
+    def test_should_decompress_content_once_per_open_file(self):
+
+        # Given opened document file
+        oid = self.conn.test_db.test_coll.save({"foo": "bar" * 1000})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        fi = FileInfo()
+        self.fuse.open(filename, fi)
+
+        # When reading it in chunks
+        content = self.fuse.read(filename, 100, 0, fi)
+        content += self.fuse.read(filename, 10000, 100, fi)
+
+        # Then whole content should be read, taken from cache once
+        self.assertEqual(mongofuse.loads(content)["foo"], "bar" * 1000)
+        self.assertEqual(self.fuse.bodies.stats()["hits"], 1)
+
+    def test_should_count_open_file_copies_against_cache_budget(self):
+
+        # Given document file opened for reading, and read
+        oid = self.conn.test_db.test_coll.save({"foo": "bar" * 1000})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        fi = FileInfo()
+        self.fuse.open(filename, fi)
+        content = self.fuse.read(filename, 10000, 0, fi)
+
+        # Then its decompressed copy should be counted in cache usage
+        self.assertEqual(self.fuse.bodies.stats()["held_bytes"], len(content))
+
+        # Until file is released
+        self.fuse.release(filename, fi)
+        self.assertEqual(self.fuse.bodies.stats()["held_bytes"], 0)
+
+    def test_should_stat_cached_document_without_decompressing(self):
+
+        # Given cached compressed document
+        oid = self.conn.test_db.test_coll.save({"foo": "bar" * 1000})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        content = self.fuse.read(filename, 10000)
+
+        # When getting its attributes
+        decompressed = []
+        codec = self.fuse.bodies._codec
+        self.fuse.bodies._codec = type("Codec", (object,), dict(
+            decompress=lambda _, data: decompressed.append(data)))()
+        try:
+            st = self.fuse.getattr(filename)
+        finally:
+            self.fuse.bodies._codec = codec
+
+        # Then size should be stored one
+        self.assertEqual(st["st_size"], len(content))
+        self.assertEqual(decompressed, [])
+
+
+class WriteStatsTest(FuseTest):
+
+    def test_should_report_writes_in_stats_file(self):
+
+        # Given document saved through opened file
+        oid = self.conn.test_db.test_coll.save({"foo": "bar"})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        fi = FileInfo(os.O_WRONLY | os.O_TRUNC)
+        self.fuse.open(filename, fi)
+        self.fuse.write(filename, '{"foo": "baz"}', 0, fi)
+        self.fuse.release(filename, fi)
+
+        # Then stats.json should count the write apart from reads
+        stats = json.loads(self.fuse.read("/stats.json", 4096))
+        self.assertEqual(stats["writes"], 1)
+
+
+class SharedCacheMountsTest(FuseTest):
+
+    def test_should_serve_documents_fetched_by_another_mount(self):
+
+        # Given two mounts sharing cache file
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        first = mongofuse.MongoFuse(conn_string=TEST_DB, shared_cache=path,
+                                    shared_cache_bytes=1 << 20)
+        second = mongofuse.MongoFuse(conn_string=TEST_DB, shared_cache=path,
+                                     shared_cache_bytes=1 << 20)
+
+        # When document is read through one of them
+        oid = self.conn.test_db.test_coll.save({"foo": "bar"})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        content = first.read(filename, 4096)
+
+        # Then the other should open and read it without asking MongoDB
+        fi = FileInfo()
+        second.open(filename, fi)
+        self.assertEqual(second.read(filename, 4096, 0, fi), content)
+        second.release(filename, fi)
+        self.assertEqual(second.getattr(filename)["st_size"], len(content))
+        self.assertEqual(second.backend.round_trips, 0)
+
+    def test_should_not_share_documents_between_servers(self):
+
+        # Given mounts of two servers sharing cache file
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        first = mongofuse.MongoFuse(conn_string=TEST_DB, shared_cache=path,
+                                    shared_cache_bytes=1 << 20)
+        second = mongofuse.MongoFuse(conn_string=TEST_DB,
+                                     replica_set="rs0", shared_cache=path,
+                                     shared_cache_bytes=1 << 20)
+
+        # When document is read through one of them
+        oid = self.conn.test_db.test_coll.save({"foo": "bar"})
+        filename = "/test_db/test_coll/{}.json".format(oid)
+        first.read(filename, 4096)
+
+        # Then the other should not find it in shared cache
+        key = ("test_db", "test_coll", oid, ".json")
+        self.assertIsNotNone(first.shared.get(key))
+        self.assertIsNone(second.shared.get(key))
+
+
+class CoalesceConcurrentRequestsTest(FuseTest):
+
+    def test_should_merge_identical_requests_in_flight(self):
+
+        # Given slow call
+        calls = []
+        release = threading.Event()
+
+        def slow_call():
+            calls.append(1)
+            release.wait()
+            return 42
+
+        # When same call is made by many threads at once
+        flights = mongofuse.SingleFlight()
+        results = []
+        threads = [threading.Thread(
+                        target=lambda: results.append(
+                            flights.do("key", slow_call)))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        # Then it should run once and share its result
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [42] * 5)
+
+    def test_should_batch_concurrent_document_reads(self):
+
+        # Given backend whose first query waits for the server
+        queries = []
+        started = threading.Event()
+        release = threading.Event()
+
+        class Collection(object):
+
+            def find(self, query):
+                queries.append(query)
+                return [{"_id": oid} for oid in query["_id"]["$in"]]
+
+        class Database(object):
+
+            def __getitem__(self, coll):
+                return Collection()
+
+        class Connection(object):
+
+            def __getitem__(self, name):
+                return Database()
+
+        def connect():
+            started.set()
+            release.wait()
+            return Connection()
+
+        backend = mongofuse.Backend(connect=connect)
+        oids = [bson.ObjectId() for n in range(10)]
+        docs = {}
+
+        def find_one(oid):
+            docs[oid] = backend.find_one("test_db", "test_coll", oid)
+
+        first = threading.Thread(target=find_one, args=(oids[0],))
+        first.start()
+        started.wait()
+
+        # When other documents are read from many threads meanwhile
+        threads = [threading.Thread(target=find_one, args=(oid,))
+                   for oid in oids[1:]]
+        for thread in threads:
+            thread.start()
+        key = ("test_db", "test_coll")
+        while key not in backend._batches or \
+                len(backend._batches[key].oids) < len(threads):
+            time.sleep(0.01)
+        release.set()
+        for thread in [first] + threads:
+            thread.join()
+
+        # Then every document should be returned
+        self.assertEqual([docs[oid]["_id"] for oid in oids], oids)
+
+        # And queued reads should be sent in one more query
+        self.assertEqual(backend.round_trips, 2)
+        self.assertEqual(queries[0], {"_id": {"$in": oids[:1]}})
+        self.assertEqual(sorted(queries[1]["_id"]["$in"]), sorted(oids[1:]))
+
+
+class ReadPreferenceTest(unittest.TestCase):
+
+    def test_should_read_from_primary_by_default(self):
+        backend = mongofuse.Backend(connect=None)
+        self.assertEqual(backend.read_options(), {})
+
+    def test_should_read_from_secondaries_within_staleness_limit(self):
+
+        # Given backend preferring secondaries lagging less than 10 seconds
+        backend = mongofuse.Backend(connect=None,
+                                    read_preference="secondaryPreferred",
+                                    max_staleness=10)
+
+        # When secondaries are fresh
+        backend.replication_lag = lambda: 3
+
+        # Then reads should go to secondaries
+        self.assertEqual(backend.read_options()['read_preference'],
+                         pymongo.ReadPreference.SECONDARY_PREFERRED)
+
+        # When secondaries lag too far behind
+        backend.replication_lag = lambda: 30
+
+        # Then reads should go to primary
+        self.assertEqual(backend.read_options()['read_preference'],
+                         pymongo.ReadPreference.PRIMARY)
+
+    def test_should_route_listings_and_stats_by_read_preference(self):
+
+        # Given backend reading from secondaries
+        calls = []
+
+        class Database(object):
+
+            def __init__(self, name):
+                self.name = name
+
+            def __getitem__(self, coll):
+                return Collection()
+
+            def command(self, command, arg=1, **options):
+                calls.append((command, options))
+                return {"ok": 1}
+
+        class Collection(object):
+
+            def find_one(self, command, **options):
+                calls.append((command.keys()[0], options))
+                return {"ok": 1,
+                        "databases": [{"name": "db"}],
+                        "cursor": {"firstBatch": [{"name": "coll"}]}}
+
+        class Connection(object):
+
+            def __getitem__(self, name):
+                return Database(name)
+
+        backend = mongofuse.Backend(connect=Connection,
+                                    read_preference="secondary")
+        secondary = dict(read_preference=pymongo.ReadPreference.SECONDARY)
+
+        # When listing databases and collections, and reading their stats
+        self.assertEqual(backend.database_names(), ["db"])
+        self.assertEqual(backend.collection_names("db"), ["coll"])
+        backend.command("db", "dbstats")
+
+        # Then all of them should go to secondaries
+        self.assertEqual(calls, [("listDatabases", secondary),
+                                 ("listCollections", secondary),
+                                 ("dbstats", secondary)])
+
+    def test_should_route_explain_by_read_preference(self):
+
+        # Given backend reading from secondaries
+        calls = []
+
+        class Collection(object):
+
+            def find_one(self, command, **options):
+                calls.append((command, options))
+                return {"ok": 1, "queryPlanner": {}}
+
+        class Database(object):
+
+            def __getitem__(self, coll):
+                return Collection()
+
+        class Connection(object):
+
+            def __getitem__(self, name):
+                return Database()
+
+        backend = mongofuse.Backend(connect=Connection,
+                                    read_preference="secondary")
+
+        # When explaining a query
+        backend.explain("db", "coll", {"foo": "bar"}, limit=5)
+
+        # Then explain command should go to secondaries, only planning it
+        [(command, options)] = calls
+        self.assertEqual(command.items(),
+                         [("explain", {"find": "coll",
+                                       "filter": {"foo": "bar"},
+                                       "limit": 5}),
+                          ("verbosity", "queryPlanner")])
+        self.assertEqual(options, dict(
+            read_preference=pymongo.ReadPreference.SECONDARY))
+
+    def test_should_measure_lag_of_slowest_secondary(self):
+
+        now = datetime.datetime(2012, 6, 30, 22, 0, 0)
+        status = {"members": [
+            {"stateStr": "PRIMARY", "optimeDate": now},
+            {"stateStr": "SECONDARY",
+             "optimeDate": now - datetime.timedelta(seconds=2)},
+            {"stateStr": "SECONDARY",
+             "optimeDate": now - datetime.timedelta(seconds=7)},
+            {"stateStr": "ARBITER", "optimeDate": now}]}
+
+        self.assertEqual(mongofuse.replication_lag(status), 7)
+        self.assertIsNone(mongofuse.replication_lag({"members": []}))
+
+    def test_should_skip_arbiters_hidden_and_delayed_members_in_lag(self):
+
+        # Given replica set with arbiter, hidden and delayed secondaries
+        now = datetime.datetime(2012, 6, 30, 22, 0, 0)
+        status = {"members": [
+            {"_id": 0, "stateStr": "PRIMARY", "optimeDate": now},
+            {"_id": 1, "stateStr": "SECONDARY",
+             "optimeDate": now - datetime.timedelta(seconds=2)},
+            {"_id": 2, "stateStr": "SECONDARY",
+             "optimeDate": now - datetime.timedelta(hours=1)},
+            {"_id": 3, "stateStr": "SECONDARY",
+             "optimeDate": now - datetime.timedelta(seconds=30)},
+            {"_id": 4, "stateStr": "ARBITER"}]}
+        config = {"members": [{"_id": 0}, {"_id": 1},
+                              {"_id": 2, "priority": 0, "hidden": True,
+                               "slaveDelay": 3600},
+                              {"_id": 3, "priority": 0, "hidden": True},
+                              {"_id": 4, "arbiterOnly": True}]}
+
+        # Then lag should be measured on secondaries serving reads only
+        self.assertEqual(mongofuse.replication_lag(status, config), 2)
+
+
+class LazyConnectionTest(unittest.TestCase):
+
+    def test_should_not_connect_until_first_operation(self):
+
+        # When creating file system for unreachable server
+        started = time.time()
+        fs = mongofuse.MongoFuse(conn_string="localhost:1",
+                                 connect_timeout=0.5)
+
+        # Then it should be created without connecting
+        self.assertLess(time.time() - started, 0.1)
+        self.assertIsNone(fs._conn)
+
+        # And first operation should fail with I/O error
+        with self.assertRaises(fuse.FuseOSError):
+            fs('readdir', '/')
+
+    def test_should_connect_on_first_operation(self):
+
+        # Given file system for reachable server
+        fs = mongofuse.MongoFuse(conn_string=TEST_DB)
+
+        # When running first operation
+        fs('readdir', '/')
+
+        # Then connection should be established
+        self.assertIsNotNone(fs._conn)
+
+
+class DefaultOperationsTest(unittest.TestCase):
+
+    def test_should_refuse_unsupported_changes_as_read_only(self):
+        fs = mongofuse.MongoFuse(conn_string=TEST_DB)
+        for op, args in [("rename", ("/a", "/b")),
+                         ("rmdir", ("/a",)),
+                         ("symlink", ("/a", "/b"))]:
+            with self.assertRaises(fuse.FuseOSError) as raised:
+                fs(op, *args)
+            self.assertEqual(raised.exception.errno, errno.EROFS)
+
+    def test_should_keep_defaults_of_read_only_operations(self):
+        fs = mongofuse.MongoFuse(conn_string=TEST_DB)
+        self.assertEqual(fs("listxattr", "/"), [])
+        self.assertEqual(fs("fsync", "/", 0, None), 0)
+
+
 class SplitPathTest(unittest.TestCase):
 
     def test_should_split_path_into_list_of_components(self):
@@ -472,6 +1618,218 @@ class SplitPathTest(unittest.TestCase):
         self.assertEqual(components, ["/", "tmp", "test"])
 
 
+class ResolvePathTest(unittest.TestCase):
+
+    def test_should_resolve_each_level_to_typed_node(self):
+
+        oid = bson.objectid.ObjectId()
+
+        # When resolving paths of every level
+        root = mongofuse.resolve_path("/")
+        db = mongofuse.resolve_path("/test_db")
+        coll = mongofuse.resolve_path("/test_db/test_coll")
+        view = mongofuse.resolve_path("/test_db/test_coll/by_age")
+        doc = mongofuse.resolve_path(
+            "/test_db/test_coll/by_age/{}.json".format(oid))
+        query = mongofuse.resolve_path("/test_db/test_coll/query.json")
+
+        # Then node kinds should match the level and name
+        self.assertEqual(root.kind, mongofuse.Node.ROOT)
+        self.assertEqual(db.kind, mongofuse.Node.DATABASE)
+        self.assertEqual(coll.kind, mongofuse.Node.COLLECTION)
+        self.assertEqual(view.kind, mongofuse.Node.VIEW)
+        self.assertEqual(doc.kind, mongofuse.Node.DOCUMENT)
+        self.assertEqual(query.kind, mongofuse.Node.QUERY)
+
+        # And database, collection and ObjectId should be filled in
+        self.assertEqual(doc.db, "test_db")
+        self.assertEqual(doc.coll, "test_coll")
+        self.assertEqual(doc.oid, oid)
+        self.assertEqual(doc.parent, "/test_db/test_coll/by_age")
+        self.assertEqual(query.parent, "/test_db/test_coll")
+
+    def test_should_treat_dotted_folder_names_as_views(self):
+
+        # Nested field names shouldn't be mistaken for document files
+        node = mongofuse.resolve_path("/test_db/test_coll/by_address.city")
+        self.assertEqual(node.kind, mongofuse.Node.VIEW)
+        self.assertIsNone(node.oid)
+
+    def test_should_memoize_resolved_paths(self):
+
+        # Resolving the same path twice should return the same node
+        path = "/test_db/test_coll/query.json"
+        self.assertIs(mongofuse.resolve_path(path),
+                      mongofuse.resolve_path(path))
+
+
+class BoundedCacheTest(unittest.TestCase):
+
+    def test_should_evict_least_recently_used_items(self):
+
+        # Given full cache
+        cache = mongofuse.BoundedCache(max_size=2)
+        cache['a'] = 1
+        cache['b'] = 2
+
+        # When using first item and adding one more
+        cache.get('a')
+        cache['c'] = 3
+
+        # Then least recently used item should be evicted
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(len(cache), 2)
+
+
+class BodyCacheTest(unittest.TestCase):
+
+    def test_should_keep_pinned_entries_while_others_are_evicted(self):
+
+        # Given body cache with entry read often
+        cache = mongofuse.BodyCache(max_bytes=20, max_pinned=1, pin_after=2,
+                                    codec="none")
+        cache.put("hot", "config")
+        cache.get("hot")
+        cache.get("hot")
+
+        # When many other entries are cached
+        for n in range(10):
+            cache.put(n, "doc")
+
+        # Then frequently read entry should be kept
+        self.assertEqual(cache.get("hot"), "config")
+        self.assertEqual(cache.stats()["pinned_hits"], 1)
+        self.assertEqual(cache.stats()["entries"], 4)
+
+    def test_should_expire_entries(self):
+        cache = mongofuse.BodyCache(ttl=0)
+        cache.put("key", "body")
+        time.sleep(0.01)
+        self.assertIsNone(cache.get("key"))
+
+
+class CompressedBodyCacheTest(unittest.TestCase):
+
+    def test_should_store_large_contents_compressed(self):
+
+        # Given cache compressing contents of 100 bytes or more
+        cache = mongofuse.BodyCache(codec="zlib", compress_min=100)
+
+        # When caching large repetitive and small contents
+        body = mongofuse.dumps({"items": [{"name": "x"}] * 100})
+        cache.put("large", body)
+        cache.put("small", "{}")
+
+        # Then they should be returned as they were
+        self.assertEqual(cache.get("large"), body)
+        self.assertEqual(cache.get("small"), "{}")
+
+        # And take less memory than uncompressed
+        stats = cache.stats()
+        self.assertEqual(stats["uncompressed_bytes"], len(body) + 2)
+        self.assertLess(stats["bytes"] * 10, stats["uncompressed_bytes"])
+
+    def test_should_evict_entries_for_bytes_held_outside(self):
+
+        # Given cache of 1000 bytes, filled
+        cache = mongofuse.BodyCache(max_bytes=1000, codec="none")
+        for n in range(3):
+            cache.put(n, "x" * 300)
+
+        # When 500 bytes are held outside of it
+        self.assertTrue(cache.reserve(500))
+
+        # Then oldest entries should be evicted for them
+        self.assertEqual(cache.stats()["bytes"], 300)
+        self.assertIsNone(cache.get(1))
+
+        # And more than the budget should not be reserved
+        self.assertFalse(cache.reserve(600))
+        cache.unreserve(500)
+        self.assertEqual(cache.stats()["held_bytes"], 0)
+
+    def test_should_evict_entries_above_byte_budget(self):
+
+        # Given cache of 1000 bytes
+        cache = mongofuse.BodyCache(max_bytes=1000, codec="none")
+
+        # When caching more than that
+        for n in range(5):
+            cache.put(n, "x" * 300)
+
+        # Then only latest entries fitting the budget should be kept
+        self.assertEqual(cache.stats()["bytes"], 900)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(4), "x" * 300)
+
+
+class SharedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+
+    def test_should_share_entries_between_cache_instances(self):
+
+        # Given two caches on the same file, as in two mount processes
+        first = mongofuse.SharedCache(self.path, size=1 << 20)
+        second = mongofuse.SharedCache(self.path, size=1 << 20)
+
+        # When content is cached by one of them
+        body = mongofuse.dumps({"items": [{"name": "x"}] * 100})
+        first.put(("db", "coll", "oid", ".json"), body)
+
+        # Then it should be returned by the other
+        self.assertEqual(second.get(("db", "coll", "oid", ".json")), body)
+
+        # Until it's dropped
+        second.pop(("db", "coll", "oid", ".json"))
+        self.assertIsNone(first.get(("db", "coll", "oid", ".json")))
+
+    def test_should_keep_slot_geometry_of_existing_file(self):
+        mongofuse.SharedCache(self.path, size=1 << 20, slot_size=4096)
+        cache = mongofuse.SharedCache(self.path, size=1 << 24)
+        self.assertEqual((cache.slots, cache.slot_size), (256, 4096))
+
+    def test_should_skip_contents_larger_than_slot(self):
+        cache = mongofuse.SharedCache(self.path, size=1 << 20,
+                                      slot_size=4096, compress_min=1 << 20)
+        cache.put("key", "x" * 5000)
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.stats()["too_large"], 1)
+
+    def test_should_expire_entries(self):
+        cache = mongofuse.SharedCache(self.path, size=1 << 20, ttl=0)
+        cache.put("key", "body")
+        time.sleep(0.01)
+        self.assertIsNone(cache.get("key"))
+
+
+class ReadAheadTest(unittest.TestCase):
+
+    def test_should_grow_window_while_reading_in_order(self):
+        readahead = mongofuse.ReadAhead(min_window=2, max_window=4)
+        readahead.listed("/db/coll", list("abcdefghij"))
+
+        self.assertEqual(readahead.accessed("/db/coll", "a"), [])
+        self.assertEqual(readahead.accessed("/db/coll", "b"), ["c", "d"])
+        self.assertEqual(readahead.accessed("/db/coll", "b"), [])
+        self.assertEqual(readahead.accessed("/db/coll", "c"), ["e", "f", "g"])
+        self.assertEqual(readahead.accessed("/db/coll", "d"), ["h"])
+
+    def test_should_reset_window_on_random_access(self):
+        readahead = mongofuse.ReadAhead(min_window=2, max_window=4)
+        readahead.listed("/db/coll", list("abcdefghij"))
+
+        readahead.accessed("/db/coll", "a")
+        readahead.accessed("/db/coll", "b")
+        self.assertEqual(readahead.accessed("/db/coll", "h"), [])
+        self.assertEqual(readahead.accessed("/db/coll", "i"), ["j"])
+
+
 class DumpsTest(unittest.TestCase):
 
     def test_should_return_pretty_printed_bson_documents(self):
@@ -546,6 +1904,72 @@ class LRUCacheTest(unittest.TestCase):
         # Then outdated items should be removed from cache
         self.assertNotIn('answer', cache)
 
+    def test_should_expire_items_from_many_threads(self):
+
+        # Given cache with many expired items
+        cache = mongofuse.LRUCache(expire_secs=0)
+        for n in range(10000):
+            dict.__setitem__(cache, n, n)
+            cache._time_added[n] = 0
+        errors = []
+
+        # When they're expired by many threads at once
+        def lookup():
+            try:
+                cache.get("key")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=lookup) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Then none of them should fail
+        self.assertEqual(errors, [])
+        self.assertEqual(len(cache), 0)
+
+    def test_should_ignore_deleting_missing_items(self):
+        cache = mongofuse.LRUCache()
+        del cache['missing']
+        self.assertIsNone(cache.pop('missing'))
+
+
+class LoadTestReportTest(unittest.TestCase):
+
+    def test_should_compute_percentiles_by_nearest_rank(self):
+        values = range(1, 101)
+        self.assertEqual(mongofuse.loadtest.percentile(values, 50), 50)
+        self.assertEqual(mongofuse.loadtest.percentile(values, 99), 99)
+        self.assertEqual(mongofuse.loadtest.percentile([7], 99), 7)
+        self.assertEqual(mongofuse.loadtest.percentile([], 50), 0)
+
+    def test_should_report_latency_and_round_trips_per_operation(self):
+
+        # Given operations recorded by load test
+        test = mongofuse.loadtest.LoadTest("/mnt", TEST_DB)
+        for n in range(10):
+            test.record("read", 0.001 * (n + 1))
+        test.record("read", 1, error=IOError())
+
+        # When reporting them
+        report = test.report(2.0, 4, {"round_trips": 5, "writes": 1},
+                             {"round_trips": 8, "writes": 3})
+
+        # Then throughput, latency, round trips and writes should be reported
+        self.assertEqual(report["ops"]["read"]["count"], 10)
+        self.assertEqual(report["ops"]["read"]["errors"], 1)
+        self.assertEqual(report["ops"]["read"]["per_second"], 5)
+        self.assertEqual(report["ops"]["read"]["p50_ms"], 5)
+        self.assertEqual(report["ops"]["read"]["p99_ms"], 10)
+        self.assertEqual(report["round_trips"], 3)
+        self.assertEqual(report["writes"], 2)
+
+    def test_should_parse_workload_mix(self):
+        self.assertEqual(mongofuse.loadtest.parse_mix("ls=4,cp"),
+                         {"ls": 4, "cp": 1})
+
 
 if __name__ == '__main__':
     unittest.main()